@@ -14,7 +14,8 @@ from .models import UserSpotifyProfile
 
 from django.utils import timezone
 
-from utils.spotify_api import get_spotify_tokens, get_spotify_details, refresh_curr_tokens
+from utils.spotify_api import get_spotify_tokens, get_spotify_details
+from utils.spotify_tokens import get_access_token
 
 
 class UserRegistrationAPIView(GenericAPIView):
@@ -178,7 +179,9 @@ class UserSpotifyRefreshAPIView(GenericAPIView):
             return Response(status=status.HTTP_400_BAD_REQUEST, data={"reauth_required": True})
 
         spotify_profile = user.spotify_profile
-        is_refreshed = refresh_curr_tokens(spotify_profile)
+        # Always asks Spotify (even if the token is still valid), so a revoked refresh token is reported here; only
+        # coalesced with a refresh that completes while this one waits
+        is_refreshed = get_access_token(spotify_profile, force=True) is not None
 
         if is_refreshed:
 
@@ -87,6 +87,25 @@ DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.sqlite3",
         "NAME": BASE_DIR / "db.sqlite3",
+        # Analysis, sync and cache writes come from many threads at once. Writers take the lock when their
+        # transaction begins (so a read-then-write can't deadlock on upgrading it) and wait up to 20s for it.
+        "OPTIONS": {"transaction_mode": "IMMEDIATE", "timeout": 20},
+        # On disk rather than Django's default shared in-memory database, whose concurrent writers fail with "table is
+        # locked" instead of waiting, so the tests' threads behave as they do in production
+        "TEST": {"NAME": BASE_DIR / "test_db.sqlite3"},
+    }
+}
+
+
+# Cache
+# https://docs.djangoproject.com/en/5.2/topics/cache/
+# Database-backed so cached state (e.g. rate limits, Deezer lookups) is shared by every worker process.
+# Create the table with `python manage.py createcachetable`.
+
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.db.DatabaseCache",
+        "LOCATION": "findmysound_cache",
     }
 }
 
@@ -198,3 +217,113 @@ SIMPLE_JWT = {
     "SLIDING_TOKEN_OBTAIN_SERIALIZER": "rest_framework_simplejwt.serializers.TokenObtainSlidingSerializer",
     "SLIDING_TOKEN_REFRESH_SERIALIZER": "rest_framework_simplejwt.serializers.TokenRefreshSlidingSerializer",
 }
+
+
+# Audio Analysis Engine
+# Number of songs analysed at once by <recommender.analysis.analyse_songs>
+ANALYSIS_WORKERS = 8
+
+# Maximum simultaneous requests per host, shared by every analysis worker in the process
+ANALYSIS_HOST_CONCURRENCY = {
+    "api.deezer.com": 8,
+    "api.reccobeats.com": 3,
+}
+ANALYSIS_DEFAULT_HOST_CONCURRENCY = 8  # e.g. Deezer's preview CDN hosts
+
+# ffmpeg transcoding pool; TRANSCODE_WORKERS defaults to the number of CPU cores
+TRANSCODE_WORKERS = None
+TRANSCODE_MAX_PENDING = None
+TRANSCODE_TIMEOUT = 60  # seconds
+
+# Stream previews from Deezer through ffmpeg straight into the ReccoBeats upload instead of buffering each step.
+# Lowers peak memory per concurrent analysis; requires ReccoBeats to accept chunked uploads.
+ANALYSIS_STREAMING = False
+
+# On-disk cache of transcoded previews, so retries and re-analysis skip the Deezer download and ffmpeg.
+# Set PREVIEW_CACHE_DIR to None to disable it.
+PREVIEW_CACHE_DIR = BASE_DIR / "cache" / "previews"
+PREVIEW_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+# Memory-mapped copy of every stored feature vector (see recommender.feature_matrix), shared by all worker processes
+# so recommendations index rows directly instead of loading them from the database. Set to None to disable it.
+FEATURE_MATRIX_DIR = BASE_DIR / "cache" / "features"
+
+# Where recommendation candidates come from: "artists" fetches the top tracks of the artists in the chosen playlists
+# from Spotify; "catalog" searches an approximate nearest-neighbour index of every song already analysed (see
+# recommender.catalog_index) for the CATALOG_CANDIDATES closest ones. A search scans the CATALOG_INDEX_NPROBE closest
+# of its ~sqrt(catalog size) partitions; more is slower but more accurate.
+CANDIDATE_SOURCES = ["artists"]
+CANDIDATE_FETCH_WORKERS = 8  # Artists whose top tracks are fetched at once (still subject to RATE_LIMITS)
+SPOTIFY_PAGE_WORKERS = 8  # Pages of playlist tracks fetched at once during a sync, across all playlists
+SYNC_OWNED_PLAYLISTS_ONLY = False  # Only sync playlists the user owns (a sync request's "owned_only" overrides this)
+
+# Playlist syncs run as background SyncJobs that the client polls every SYNC_POLL_INTERVAL seconds. A job that hasn't
+# made progress for SYNC_JOB_TIMEOUT is assumed dead (e.g. its process was restarted); the next sync resumes it.
+SYNC_POLL_INTERVAL = 1  # seconds
+SYNC_JOB_TIMEOUT = timedelta(minutes=10)
+
+# Spotify access tokens are refreshed this long before they expire (see utils.spotify_tokens)
+SPOTIFY_TOKEN_REFRESH_MARGIN = timedelta(minutes=5)
+
+# Artists' Spotify top tracks are cached for ARTIST_TOP_TRACKS_TTL. Older entries are still used, and refreshed in the
+# background, until they're ARTIST_TOP_TRACKS_STALE_TTL old. SPOTIFY_MARKET (an ISO country code) picks the market
+# top tracks are fetched and cached for; None leaves it to Spotify.
+ARTIST_TOP_TRACKS_TTL = timedelta(days=1)
+ARTIST_TOP_TRACKS_STALE_TTL = timedelta(days=7)
+ARTIST_TOP_TRACKS_REFRESH_WORKERS = 4  # Stale entries refreshed at once in the background, per process
+SPOTIFY_MARKET = None
+
+CATALOG_CANDIDATES = 500
+CATALOG_INDEX_NPROBE = 8
+
+# Memory budget (bytes) of each tile of similarities computed by the "max" and "topk" scoring modes
+SIMILARITY_MEMORY_LIMIT = 64 * 1024 * 1024
+
+# Deezer ISRC -> preview URL lookups are cached for DEEZER_PREVIEW_TTL seconds (or until the signed URL expires,
+# whichever is sooner). Tracks Deezer has no preview for are remembered for DEEZER_NO_PREVIEW_TTL seconds.
+DEEZER_PREVIEW_TTL = 60 * 60
+DEEZER_NO_PREVIEW_TTL = 24 * 60 * 60
+
+# Songs that fail analysis (no preview, rejected by ReccoBeats, ...) are skipped until retried with exponential
+# backoff: ANALYSIS_RETRY_BACKOFF after the first failure, doubling each time up to ANALYSIS_RETRY_BACKOFF_MAX.
+ANALYSIS_RETRY_BACKOFF = timedelta(hours=1)
+ANALYSIS_RETRY_BACKOFF_MAX = timedelta(days=30)
+
+# Analysis backends, tried in order until one succeeds: "reccobeats" uploads the preview to ReccoBeats, "local"
+# computes the features offline with recommender.features. e.g. ["reccobeats", "local"] falls back to local analysis.
+ANALYSIS_BACKENDS = ["reccobeats"]
+
+# Every outgoing request goes through recommender.http_client: one keep-alive Session per host (with up to
+# HTTP_POOL_SIZE connections), HTTP_TIMEOUT (connect, read) seconds unless a call sets its own, and up to HTTP_RETRIES
+# retries with jittered exponential backoff for idempotent requests that fail to connect, time out or get a 5xx.
+# HTTP_REQUEST_HOOKS are called with the latency and size of every attempt.
+HTTP_POOL_SIZE = 16
+HTTP_TIMEOUT = (3.05, 30)
+HTTP_RETRIES = 3
+HTTP_RETRY_BACKOFF = 0.5  # seconds, doubling with each retry up to HTTP_RETRY_BACKOFF_MAX
+HTTP_RETRY_BACKOFF_MAX = 8
+HTTP_REQUEST_HOOKS = ["recommender.http_client.log_slow_requests"]
+HTTP_SLOW_REQUEST_SECONDS = 2
+
+# Shared per-host token buckets (see recommender.ratelimit): <rate> requests per second with bursts of up to <burst>.
+# Hosts not listed here aren't throttled.
+#
+# Spotify doesn't publish its limit; it counts each app's requests over a rolling 30 second window and answers 429
+# with a Retry-After once it's exceeded, which blocks the host for every worker. Its bucket is therefore sized to let
+# the concurrent fetches through (SPOTIFY_PAGE_WORKERS and CANDIDATE_FETCH_WORKERS, at roughly 3 requests per second
+# each) and leaves the hard limit to the 429 handling; at most rate * 30 + burst (850) requests go out per window.
+# Lowering it spreads requests out to avoid 429s, but a sync or recommendation then takes as long as the bucket
+# allows (e.g. the ~240 requests of a 120-playlist sync need ~45s at 5/s with a burst of 20, and ~6s here).
+RATE_LIMITS = {
+    "api.spotify.com": {"rate": 25, "burst": 100},
+    "api.deezer.com": {"rate": 10, "burst": 50},  # Deezer allows 50 requests per 5 seconds
+    "api.reccobeats.com": {"rate": 2, "burst": 5},
+}
+
+# Run audio analysis in `manage.py analysis_worker` processes instead of inside find-music requests. Requests then
+# only queue AnalysisJobs and answer 202 (polled every ANALYSIS_POLL_INTERVAL seconds) until the songs are analysed.
+ANALYSIS_IN_BACKGROUND = False
+ANALYSIS_POLL_INTERVAL = 3  # seconds
+ANALYSIS_JOB_FAILURE_COOLDOWN = timedelta(minutes=10)  # Don't re-queue a failed job within this window
+ANALYSIS_JOB_TIMEOUT = timedelta(minutes=10)  # Running jobs older than this are assumed orphaned and re-queued
+ANALYSIS_JOB_MAX_ATTEMPTS = 3  # A job whose batch broke off this many times fails rather than being re-queued
@@ -92,19 +92,33 @@ export async function getSpotifyPlaylists(navigate, setUser, location) {
             }
         }
 
-        const response = await axios.post("/recommender/playlists", {}, config);
+        // The sync runs as a background job; poll its progress until it's finished
+        let response = await axios.post("/recommender/playlists", {}, config);
+        const jobId = response.data?.job_id;
+
+        do {
+            await new Promise((resolve) => setTimeout(resolve, (response.data?.retry_after ?? 1) * 1000));
+            response = await axios.get(`/recommender/sync/${jobId}`, config);
+        } while (response.data?.status === "pending" || response.data?.status === "running");
+
+        if (response.data?.status === "failed") {
+            if (response.data?.reauth_required) {
+                navigate("/FindMySound/accounts/authorize", {state: {from: location.pathname}});
+            }
+            return;
+        }
 
         setUser((user) => ({
             ...user,
             spotify_profile: {
                 ...user?.spotify_profile,
-                user_playlists: response.data
+                user_playlists: response.data?.playlists
             }
         }));
 
     } catch (error) {
 
-        if (error.response.data.reauth_required) {
+        if (error?.response?.data?.reauth_required) {
             navigate("/FindMySound/accounts/authorize", {state: {from: location.pathname}});
         }
     }
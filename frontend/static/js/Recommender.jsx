@@ -47,6 +47,7 @@ export default function Recommender() {
     const [isSubmitLoading, setIsSubmitLoading] = useState(false);
     const [isResponseSuccessful, setIsResponseSuccessful] = useState(false);
     const [responseData, setResponseData] = useState();
+    const [pendingAnalyses, setPendingAnalyses] = useState(0);
 
     useEffect(() => {
         if (isResponseSuccessful) {
@@ -76,7 +77,16 @@ export default function Recommender() {
                     "Authorization": `Bearer ${localStorage.getItem("accessToken")}`
                 }
             }
-            const response = await axios.post("/recommender/find-music", playlistsToSend, config);
+            let response = await axios.post("/recommender/find-music", playlistsToSend, config);
+
+            // 202: songs are still being analysed in the background; poll until the recommendation is ready
+            while (response.status === 202) {
+                setPendingAnalyses(response.data?.pending ?? 0);
+                await new Promise((resolve) => setTimeout(resolve, (response.data?.retry_after ?? 3) * 1000));
+                response = await axios.post("/recommender/find-music", playlistsToSend, config);
+            }
+
+            setPendingAnalyses(0);
 
             if (response.status === 200) {
                 setErrorMsg('');
@@ -95,6 +105,7 @@ export default function Recommender() {
                 navigate("/FindMySound/accounts/authorize");
             }
         } finally {
+            setPendingAnalyses(0);
             setIsSubmitLoading(false);
         }
     }
@@ -119,7 +130,9 @@ export default function Recommender() {
                 <h2 id="playlists-header">My Playlists</h2>
                 <p className="desc">
                     {isSubmitLoading ?
-                        "Curating your recommendations..." :
+                        (pendingAnalyses > 0 ?
+                            `Analysing ${pendingAnalyses} songs...` :
+                            "Curating your recommendations...") :
                         "Select playlists to tailor your recommendation."
                     }
                 </p>
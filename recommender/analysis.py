@@ -0,0 +1,127 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+from django.conf import settings
+
+from .threads import closing_connection
+
+# Fallbacks for when the project settings don't configure the engine
+DEFAULT_WORKERS = 8
+DEFAULT_HOST_CONCURRENCY = 4
+MAX_RATE_LIMIT_RETRIES = 3
+DEFAULT_RETRY_SECONDS = 2
+
+_host_semaphores: dict[str, threading.BoundedSemaphore] = {}
+_host_semaphores_lock = threading.Lock()
+
+
+def get_worker_count() -> int:
+    return getattr(settings, "ANALYSIS_WORKERS", DEFAULT_WORKERS)
+
+
+def get_host_semaphore(host: str) -> threading.BoundedSemaphore:
+    """Return the process-wide semaphore capping concurrent requests to <host>"""
+    with _host_semaphores_lock:
+        if host not in _host_semaphores:
+            limits = getattr(settings, "ANALYSIS_HOST_CONCURRENCY", {})
+            default = getattr(settings, "ANALYSIS_DEFAULT_HOST_CONCURRENCY", DEFAULT_HOST_CONCURRENCY)
+            _host_semaphores[host] = threading.BoundedSemaphore(limits.get(host, default))
+
+        return _host_semaphores[host]
+
+
+@contextmanager
+def host_slot(url: str):
+    """Hold one of the concurrency slots of <url>'s host for the duration of the block.
+
+    Analysis workers share these slots, so raising ANALYSIS_WORKERS never sends more than the configured number
+    of simultaneous requests to a single provider (e.g. ReccoBeats).
+    """
+    semaphore = get_host_semaphore(urlparse(url).netloc)
+
+    with semaphore:
+        yield
+
+
+def analyse_songs(songs, num_workers: int | None = None) -> list:
+    """Run <Song.set_song_analysis> for every song in <songs> concurrently.
+
+    Returns a list with one entry per song, in the same order as <songs>: the result of set_song_analysis (a 429
+    result means the song was still rate-limited after MAX_RATE_LIMIT_RETRIES), or None if it could not be analysed.
+    """
+    songs = list(songs)
+
+    if not songs:
+        return []
+
+    return asyncio.run(_analyse_songs(songs, num_workers or get_worker_count()))
+
+
+def analysed_vector(result) -> list | None:
+    """Return the feature vector in an <analyse_songs> result, or None if the song wasn't analysed.
+
+    Only a (200, feature_vector) result carries a vector: (429, retry_seconds) is truthy too, but its second item is a
+    retry delay, not features.
+    """
+    if result and result[0] == 200:
+        return result[1]
+
+    return None
+
+
+async def _analyse_songs(songs: list, num_workers: int) -> list:
+    queue = asyncio.Queue()
+    results = [None] * len(songs)
+
+    # Queue entries remember their position in <songs> so results land in input order no matter which worker
+    # finishes first (or how many times a song gets re-queued after a rate limit).
+    for index, song in enumerate(songs):
+        queue.put_nowait((index, song, 0))
+
+    num_workers = min(num_workers, len(songs))
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="analysis")
+
+    # Same design as the standalone <Playlist.get_playlist_analysis>: each worker pulls a song off the queue and
+    # analyses it. The blocking pipeline (Deezer lookup, preview download, ffmpeg transcode, ReccoBeats upload) runs
+    # on the executor so <num_workers> songs progress at once; per-host caps are enforced inside the pipeline itself
+    # through <host_slot>.
+    async def worker():
+        while True:
+            index, song, attempt = await queue.get()
+            try:
+                result = await loop.run_in_executor(executor, _run_song_analysis, song)
+
+                if result and result[0] == 429 and attempt < MAX_RATE_LIMIT_RETRIES:
+                    time_to_wait = result[1] or DEFAULT_RETRY_SECONDS
+
+                    print(f"Rate limited on {song.song_title}; retrying in {time_to_wait}s")
+                    await asyncio.sleep(time_to_wait)
+                    await queue.put((index, song, attempt + 1))
+                else:
+                    results[index] = result
+            except Exception as e:
+                print(f"Error for {song.song_title}: {e}")
+            finally:
+                queue.task_done()
+
+    workers = [asyncio.create_task(worker()) for _ in range(num_workers)]
+
+    try:
+        await queue.join()  # Wait for all songs to be processed
+    finally:
+        for w in workers:
+            w.cancel()
+
+        await asyncio.gather(*workers, return_exceptions=True)
+        executor.shutdown(wait=True)
+
+    return results
+
+
+@closing_connection
+def _run_song_analysis(song):
+    return song.set_song_analysis()
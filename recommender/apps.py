@@ -4,3 +4,9 @@ from django.apps import AppConfig
 class RecommenderConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "recommender"
+
+    def ready(self):
+        from .transcoding import get_transcoder
+
+        # Resolve the bundled ffmpeg binary once at startup rather than on the first analysed song
+        get_transcoder()
@@ -0,0 +1,156 @@
+import threading
+
+import numpy as np
+from django.conf import settings
+
+from .feature_matrix import FeatureMatrix, get_feature_matrix
+from .scoring import normalize_rows, top_n
+
+DEFAULT_NPROBE = 8
+KMEANS_ITERATIONS = 10
+TRAINING_SAMPLE_SIZE = 50000
+ASSIGNMENT_BLOCK_SIZE = 65536
+RETRAIN_GROWTH = 2  # Retrain once the catalog has grown this many times over since the last training
+
+_catalog_index = None
+_catalog_index_lock = threading.Lock()
+
+
+class CatalogIndex:
+    """An inverted file (IVF) index for approximate cosine nearest-neighbour search over a <FeatureMatrix>.
+
+    The normalized vectors are partitioned with spherical k-means into about sqrt(N) lists. A search only scores the
+    vectors in the <nprobe> lists whose centroids are closest to the query, so it touches a small fraction of the
+    catalog. Rows appended to the matrix since the last search are assigned to their nearest existing list; the lists
+    are retrained from scratch once the catalog has grown RETRAIN_GROWTH times over, or whenever the matrix is
+    rebuilt (which may remove or reorder rows).
+
+    Vectors are always read from the matrix at search time, so rows overwritten by a re-analysis are scored with
+    their current value (though they stay in the list they were first assigned to until the next retraining).
+    """
+
+    def __init__(self, feature_matrix: FeatureMatrix, nprobe: int = DEFAULT_NPROBE) -> None:
+        self.feature_matrix = feature_matrix
+        self.nprobe = nprobe
+
+        self._lock = threading.Lock()
+        self._isrcs: list[str] = []
+        self._matrix = None
+        self._centroids = None
+        self._assignments = np.empty(0, dtype=np.intp)
+        self._trained_rows = 0
+        self._generation = None  # The matrix generation the lists were built from
+        self._list_rows = np.empty(0, dtype=np.intp)  # Row numbers grouped by list
+        self._list_offsets = np.zeros(1, dtype=np.intp)  # List i is _list_rows[_list_offsets[i]:_list_offsets[i + 1]]
+
+    def search(self, query_vectors: np.ndarray, k: int, exclude: set[str] = frozenset()) -> list[str]:
+        """Return the ISRCs of up to <k> catalog songs closest to the centroid of <query_vectors>, closest first.
+
+        The centroid of the normalized query vectors is the direction that maximizes the mean cosine similarity to
+        all of them, so this finds the songs <scoring.mean_similarity> would rank highest. ISRCs in <exclude> (e.g.
+        the user's own songs) are skipped.
+        """
+        with self._lock:
+            self._refresh()
+
+            if self._centroids is None or len(query_vectors) == 0:
+                return []
+
+            query = normalize_rows(query_vectors).mean(axis=0)
+
+            if not np.any(query):
+                return []
+
+            probed = top_n(self._centroids @ query, self.nprobe)
+            rows = np.concatenate([self._list_rows[self._list_offsets[i]:self._list_offsets[i + 1]] for i in probed])
+            similarities = normalize_rows(self._matrix[rows]) @ query
+
+            isrcs = []
+
+            for row in rows[top_n(similarities, k + len(exclude))]:
+                if self._isrcs[row] not in exclude:
+                    isrcs.append(self._isrcs[row])
+
+            return isrcs[:k]
+
+    def _refresh(self) -> None:
+        generation, isrcs, matrix = self.feature_matrix.snapshot()
+
+        if not isrcs:
+            self._centroids = None
+            self._assignments = np.empty(0, dtype=np.intp)
+            return
+
+        # Our row numbers only hold while rows are appended; after a rebuild start again
+        rebuilt = generation != self._generation or len(isrcs) < len(self._assignments)
+
+        if self._centroids is None or rebuilt or len(isrcs) >= RETRAIN_GROWTH * self._trained_rows:
+            self._train(matrix)
+            self._assignments = self._assign(matrix)
+            self._trained_rows = len(isrcs)
+            self._generation = generation
+        elif len(isrcs) > len(self._assignments):
+            self._assignments = np.concatenate([self._assignments, self._assign(matrix[len(self._assignments):])])
+        else:
+            self._matrix = matrix
+            return
+
+        self._isrcs = isrcs
+        self._matrix = matrix
+
+        self._list_rows = np.argsort(self._assignments, kind="stable")
+        counts = np.bincount(self._assignments, minlength=len(self._centroids))
+        self._list_offsets = np.concatenate([[0], np.cumsum(counts)])
+
+    def _train(self, matrix: np.ndarray) -> None:
+        """Fit about sqrt(N) list centroids to the rows of <matrix> with spherical k-means"""
+        rng = np.random.default_rng(0)
+
+        sample_rows = np.arange(len(matrix))
+        if len(matrix) > TRAINING_SAMPLE_SIZE:
+            sample_rows = np.sort(rng.choice(len(matrix), TRAINING_SAMPLE_SIZE, replace=False))
+
+        sample = normalize_rows(matrix[sample_rows])
+        num_lists = max(1, int(np.sqrt(len(matrix))))
+        num_lists = min(num_lists, len(sample))
+
+        centroids = sample[rng.choice(len(sample), num_lists, replace=False)]
+
+        for _ in range(KMEANS_ITERATIONS):
+            labels = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, sample)
+
+            # A list that lost all its members keeps its previous centroid
+            empty = ~np.any(sums, axis=1)
+            sums[empty] = centroids[empty]
+            centroids = normalize_rows(sums)
+
+        self._centroids = centroids
+
+    def _assign(self, matrix: np.ndarray) -> np.ndarray:
+        """Return the list closest to each row of <matrix>"""
+        assignments = np.empty(len(matrix), dtype=np.intp)
+
+        # In blocks, so the (rows x lists) similarities stay small however large the catalog is
+        for start in range(0, len(matrix), ASSIGNMENT_BLOCK_SIZE):
+            block = normalize_rows(matrix[start:start + ASSIGNMENT_BLOCK_SIZE])
+            assignments[start:start + len(block)] = np.argmax(block @ self._centroids.T, axis=1)
+
+        return assignments
+
+
+def get_catalog_index() -> CatalogIndex | None:
+    """Return the process-wide <CatalogIndex>, or None if there's no feature matrix to index"""
+    global _catalog_index
+
+    feature_matrix = get_feature_matrix()
+
+    if feature_matrix is None:
+        return None
+
+    with _catalog_index_lock:
+        if _catalog_index is None:
+            _catalog_index = CatalogIndex(feature_matrix, getattr(settings, "CATALOG_INDEX_NPROBE", DEFAULT_NPROBE))
+
+        return _catalog_index
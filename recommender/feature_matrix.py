@@ -0,0 +1,242 @@
+import os
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterable
+
+import numpy as np
+from django.conf import settings
+
+from .features import FEATURE_DTYPE, FEATURE_NAMES
+
+try:
+    import fcntl
+except ImportError:  # e.g. Windows; writers are then only serialised within a process
+    fcntl = None
+
+INITIAL_CAPACITY = 1024
+
+_feature_matrix = None
+_feature_matrix_lock = threading.Lock()
+
+
+class FeatureMatrix:
+    """A memory-mapped matrix of stored feature vectors, shared by every process through the filesystem.
+
+    Layout:
+        - features.npy: A (capacity x len(FEATURE_NAMES)) float32 array; row i is the vector of the i-th ISRC
+        - isrcs.txt: One ISRC per line, in row order
+        - lock: Serialises writers across processes, and keeps readers from catching up with a half-finished rebuild
+
+    Readers map features.npy read-only, so the matrix is held once in the page cache however many workers use it,
+    and they pick up rows appended by other processes by reading the new tail of isrcs.txt. A writer fills in a row
+    before appending its ISRC, so a reader never sees an ISRC without its vector. When the matrix is full it's copied
+    into a file of twice the capacity which is swapped in with os.replace; readers notice and remap it. A rebuild
+    replaces both files while holding the lock exclusively, and readers take it shared to pick up changes, so the
+    index and the matrix a reader maps always belong together.
+    """
+
+    def __init__(self, directory: Path) -> None:
+        self.directory = Path(directory)
+        self.matrix_path = self.directory / "features.npy"
+        self.isrcs_path = self.directory / "isrcs.txt"
+        self.lock_path = self.directory / "lock"
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+        self._lock = threading.RLock()
+        self._matrix = None
+        self._matrix_inode = None
+        self._isrcs_inode = None
+        self._isrcs_offset = 0
+        self._index: dict[str, int] = {}
+        self._seen_stats = None  # (isrcs inode, isrcs size, matrix inode) as of the last catch-up
+        self._generation = 0  # Bumped whenever the rows are replaced wholesale (i.e. by a rebuild)
+
+    def __len__(self) -> int:
+        with self._lock:
+            self._refresh()
+            return len(self._index)
+
+    def lookup(self, isrcs: Iterable[str]) -> tuple[list[str], np.ndarray]:
+        """Return the ISRCs in <isrcs> that are in the matrix, along with their row numbers (same order)"""
+        with self._lock:
+            self._refresh()
+            found = [isrc for isrc in isrcs if isrc in self._index]
+            rows = np.fromiter((self._index[isrc] for isrc in found), dtype=np.intp, count=len(found))
+
+            return found, rows
+
+    def vectors(self, isrcs: Iterable[str]) -> tuple[list[str], np.ndarray]:
+        """Return the ISRCs in <isrcs> that are in the matrix, along with a copy of their vectors (same order)"""
+        with self._lock:
+            found, rows = self.lookup(isrcs)
+
+            if not found:
+                return [], np.empty((0, len(FEATURE_NAMES)), dtype=FEATURE_DTYPE)
+
+            return found, self._matrix[rows]
+
+    def snapshot(self) -> tuple[int, list[str], np.ndarray]:
+        """Return the matrix's generation, every ISRC in it and a read-only view of their vectors, without copying them.
+
+        Rows are only ever appended (or overwritten in place) within a generation; a new generation means the matrix
+        was rebuilt, so rows may have been removed or reordered.
+        """
+        with self._lock:
+            self._refresh()
+
+            if self._matrix is None:
+                return self._generation, [], np.empty((0, len(FEATURE_NAMES)), dtype=FEATURE_DTYPE)
+
+            return self._generation, list(self._index), self._matrix[:len(self._index)]
+
+    def append(self, vectors: dict[str, np.ndarray]) -> None:
+        """Store the vectors in <vectors> (ISRC -> vector), overwriting the rows of ISRCs already in the matrix"""
+        if not vectors:
+            return
+
+        with self._lock, self._file_lock():
+            self._catch_up()
+
+            new_isrcs = [isrc for isrc in vectors if isrc not in self._index]
+            start = len(self._index)
+            matrix = self._open_writable(start + len(new_isrcs))
+
+            for isrc, vector in vectors.items():
+                if isrc in self._index:
+                    matrix[self._index[isrc]] = vector
+
+            for row, isrc in enumerate(new_isrcs, start):
+                matrix[row] = vectors[isrc]
+
+            matrix.flush()
+            del matrix
+
+            with open(self.isrcs_path, "a", encoding="ascii") as f:
+                f.write("".join(f"{isrc}\n" for isrc in new_isrcs))
+
+            self._catch_up()
+
+    def rebuild(self, isrcs: list[str], vectors: np.ndarray) -> None:
+        """Replace the whole matrix with <vectors>, whose rows belong to <isrcs>"""
+        capacity = max(INITIAL_CAPACITY, len(isrcs))
+        temp_matrix_path = self.directory / "features.tmp.npy"
+        temp_isrcs_path = self.directory / "isrcs.tmp"
+
+        with self._lock, self._file_lock():
+            matrix = np.lib.format.open_memmap(temp_matrix_path, mode="w+", dtype=FEATURE_DTYPE,
+                                               shape=(capacity, len(FEATURE_NAMES)))
+            matrix[:len(isrcs)] = vectors
+            matrix.flush()
+            del matrix
+
+            temp_isrcs_path.write_text("".join(f"{isrc}\n" for isrc in isrcs), encoding="ascii")
+
+            os.replace(temp_matrix_path, self.matrix_path)
+            os.replace(temp_isrcs_path, self.isrcs_path)
+
+            self._catch_up()
+
+    def _refresh(self) -> None:
+        """Catch up with rows appended (or a rebuild made) since the last call, by this or any other process"""
+        try:
+            stats = (os.stat(self.isrcs_path), os.stat(self.matrix_path))
+        except FileNotFoundError:
+            return
+
+        # Nothing has changed, so there's no need to wait for writers
+        if (stats[0].st_ino, stats[0].st_size, stats[1].st_ino) == self._seen_stats:
+            return
+
+        with self._file_lock(shared=True):
+            self._catch_up()
+
+    def _catch_up(self) -> None:
+        """<_refresh>, for callers already holding the file lock"""
+        try:
+            isrcs_stat = os.stat(self.isrcs_path)
+            matrix_stat = os.stat(self.matrix_path)
+        except FileNotFoundError:
+            return
+
+        self._seen_stats = (isrcs_stat.st_ino, isrcs_stat.st_size, matrix_stat.st_ino)
+
+        # Rebuilt since we last looked; start again from the new files
+        if isrcs_stat.st_ino != self._isrcs_inode or isrcs_stat.st_size < self._isrcs_offset:
+            self._isrcs_inode = isrcs_stat.st_ino
+            self._isrcs_offset = 0
+            self._index = {}
+            self._generation += 1
+
+        if isrcs_stat.st_size > self._isrcs_offset:
+            with open(self.isrcs_path, "rb") as f:
+                f.seek(self._isrcs_offset)
+                data = f.read()
+
+            end = data.rfind(b"\n") + 1  # Leave a line that's still being written for next time
+
+            for isrc in data[:end].decode("ascii").splitlines():
+                self._index[isrc] = len(self._index)
+
+            self._isrcs_offset += end
+
+        if (self._matrix is None or matrix_stat.st_ino != self._matrix_inode
+                or len(self._matrix) < len(self._index)):
+            self._matrix = np.load(self.matrix_path, mmap_mode="r")
+            self._matrix_inode = matrix_stat.st_ino
+
+    def _open_writable(self, rows: int) -> np.memmap:
+        """Map the matrix for writing, growing (or creating) it first if it has room for fewer than <rows> rows"""
+        temp_path = self.directory / "features.tmp.npy"
+
+        if not self.matrix_path.exists():
+            matrix = np.lib.format.open_memmap(temp_path, mode="w+", dtype=FEATURE_DTYPE,
+                                               shape=(max(INITIAL_CAPACITY, rows), len(FEATURE_NAMES)))
+            matrix.flush()
+            del matrix
+            os.replace(temp_path, self.matrix_path)
+
+        matrix = np.load(self.matrix_path, mmap_mode="r+")
+
+        if len(matrix) >= rows:
+            return matrix
+
+        # Readers may still have the old file mapped, so grow into a copy rather than resizing it in place
+        grown = np.lib.format.open_memmap(temp_path, mode="w+", dtype=FEATURE_DTYPE,
+                                          shape=(max(rows, 2 * len(matrix)), len(FEATURE_NAMES)))
+        grown[:len(matrix)] = matrix
+        grown.flush()
+        del grown, matrix
+
+        os.replace(temp_path, self.matrix_path)
+
+        return np.load(self.matrix_path, mmap_mode="r+")
+
+    @contextmanager
+    def _file_lock(self, shared: bool = False):
+        with open(self.lock_path, "a") as f:
+            if fcntl:
+                fcntl.flock(f, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+
+            try:
+                yield
+            finally:
+                if fcntl:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def get_feature_matrix() -> FeatureMatrix | None:
+    """Return the process-wide <FeatureMatrix>, or None if FEATURE_MATRIX_DIR is unset"""
+    global _feature_matrix
+
+    directory = getattr(settings, "FEATURE_MATRIX_DIR", None)
+
+    if not directory:
+        return None
+
+    with _feature_matrix_lock:
+        if _feature_matrix is None:
+            _feature_matrix = FeatureMatrix(directory)
+
+        return _feature_matrix
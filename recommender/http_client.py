@@ -0,0 +1,186 @@
+import random
+import threading
+import time
+from typing import Callable
+from urllib.parse import urlparse
+
+import requests
+from django.conf import settings
+from django.utils.module_loading import import_string
+from requests.adapters import HTTPAdapter
+
+DEFAULT_TIMEOUT = (3.05, 30)  # (connect, read) seconds
+DEFAULT_POOL_SIZE = 16  # Keep-alive connections kept per host
+DEFAULT_RETRIES = 3
+DEFAULT_RETRY_BACKOFF = 0.5  # seconds; doubles with each retry, up to DEFAULT_RETRY_BACKOFF_MAX
+DEFAULT_RETRY_BACKOFF_MAX = 8
+
+# Only these are retried automatically: sending them twice has the same effect as sending them once
+IDEMPOTENT_METHODS = frozenset({"GET", "HEAD", "OPTIONS", "PUT", "DELETE"})
+RETRY_STATUSES = frozenset({500, 502, 503, 504})
+
+_sessions: dict[str, requests.Session] = {}
+_sessions_lock = threading.Lock()
+_hooks: list[Callable] | None = None
+_hooks_lock = threading.Lock()
+
+
+class RequestStats:
+    """What a single attempt of a request cost, as passed to every request hook.
+
+    Instance Attributes:
+        - method, url: The request
+        - attempt: 0 for the first attempt, then 1, 2, ... for retries
+        - status_code: The response's status, or None if no response was received
+        - elapsed: Seconds until the response's headers arrived (or the request failed)
+        - bytes_sent: Size of the request body, or None if it was streamed
+        - bytes_received: Size of the response body, or None if it's streamed and has no Content-Length
+        - error: The exception the attempt failed with, if any
+    """
+
+    method: str
+    url: str
+    attempt: int
+    status_code: int | None
+    elapsed: float
+    bytes_sent: int | None
+    bytes_received: int | None
+    error: Exception | None
+
+    def __init__(self, method: str, url: str, attempt: int, status_code: int | None, elapsed: float,
+                 bytes_sent: int | None, bytes_received: int | None, error: Exception | None = None) -> None:
+        self.method = method
+        self.url = url
+        self.attempt = attempt
+        self.status_code = status_code
+        self.elapsed = elapsed
+        self.bytes_sent = bytes_sent
+        self.bytes_received = bytes_received
+        self.error = error
+
+    @property
+    def host(self) -> str:
+        return urlparse(self.url).netloc
+
+
+def get_session(url: str) -> requests.Session:
+    """Return the process-wide Session for <url>'s host, whose connections are kept alive and reused"""
+    host = urlparse(url).netloc
+
+    with _sessions_lock:
+        if host not in _sessions:
+            pool_size = getattr(settings, "HTTP_POOL_SIZE", DEFAULT_POOL_SIZE)
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+
+            session = requests.Session()
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _sessions[host] = session
+
+        return _sessions[host]
+
+
+def add_request_hook(hook: Callable[[RequestStats], None]) -> None:
+    """Call <hook> with the <RequestStats> of every request attempt made through this module"""
+    hooks = _get_hooks()
+
+    with _hooks_lock:
+        hooks.append(hook)
+
+
+def request(method: str, url: str, retries: int | None = None, **kwargs) -> requests.Response:
+    """Send a request over <url>'s pooled Session, with default timeouts (settings.HTTP_TIMEOUT).
+
+    Idempotent requests that fail to connect, time out or get a 5xx are retried up to <retries> times
+    (settings.HTTP_RETRIES by default) with jittered exponential backoff; others are only ever sent once. The last
+    response is returned whatever its status, and the last exception is raised if every attempt failed.
+    """
+    method = method.upper()
+    kwargs.setdefault("timeout", getattr(settings, "HTTP_TIMEOUT", DEFAULT_TIMEOUT))
+
+    if retries is None:
+        retries = getattr(settings, "HTTP_RETRIES", DEFAULT_RETRIES)
+
+    if method not in IDEMPOTENT_METHODS:
+        retries = 0
+
+    session = get_session(url)
+
+    for attempt in range(retries + 1):
+        start_time = time.perf_counter()
+
+        try:
+            response = session.request(method, url, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            _run_hooks(RequestStats(method, url, attempt, None, time.perf_counter() - start_time, None, None, e))
+
+            if attempt == retries:
+                raise
+
+            _backoff(attempt)
+            continue
+
+        _run_hooks(RequestStats(method, url, attempt, response.status_code, response.elapsed.total_seconds(),
+                                _body_size(response.request.body), _content_size(response, kwargs)))
+
+        if response.status_code not in RETRY_STATUSES or attempt == retries:
+            return response
+
+        response.close()  # Return the connection to the pool
+        _backoff(attempt)
+
+
+def _backoff(attempt: int) -> None:
+    # "Full jitter": a random wait up to the exponential backoff, so clients that failed together don't retry together
+    base = getattr(settings, "HTTP_RETRY_BACKOFF", DEFAULT_RETRY_BACKOFF)
+    maximum = getattr(settings, "HTTP_RETRY_BACKOFF_MAX", DEFAULT_RETRY_BACKOFF_MAX)
+
+    time.sleep(random.uniform(0, min(maximum, base * 2 ** attempt)))
+
+
+def _body_size(body) -> int | None:
+    if body is None:
+        return 0
+    elif isinstance(body, (bytes, str)):
+        return len(body)
+
+    return None  # e.g. a generator, sent with chunked transfer encoding
+
+
+def _content_size(response: requests.Response, kwargs: dict) -> int | None:
+    if not kwargs.get("stream"):
+        return len(response.content)
+
+    content_length = response.headers.get("Content-Length")
+
+    return int(content_length) if content_length and content_length.isdigit() else None
+
+
+def _get_hooks() -> list[Callable]:
+    global _hooks
+
+    with _hooks_lock:
+        if _hooks is None:
+            _hooks = [import_string(path) for path in getattr(settings, "HTTP_REQUEST_HOOKS", [])]
+
+        return _hooks
+
+
+def _run_hooks(stats: RequestStats) -> None:
+    for hook in _get_hooks():
+        try:
+            hook(stats)
+        except Exception as e:
+            # Instrumentation must never break the request it's measuring
+            print(f"Request hook {hook!r} failed: {e!r}")
+
+
+def log_slow_requests(stats: RequestStats) -> None:
+    """A request hook that prints every attempt slower than settings.HTTP_SLOW_REQUEST_SECONDS, or that failed"""
+    threshold = getattr(settings, "HTTP_SLOW_REQUEST_SECONDS", 2)
+
+    if stats.error is not None:
+        print(f"{stats.method} {stats.host} failed after {stats.elapsed:.2f}s (attempt {stats.attempt}): {stats.error}")
+    elif stats.elapsed > threshold or stats.status_code >= 500:
+        print(f"{stats.method} {stats.host} -> {stats.status_code} in {stats.elapsed:.2f}s "
+              f"(attempt {stats.attempt}, {stats.bytes_received} bytes)")
@@ -0,0 +1,196 @@
+from typing import Iterable
+
+from django.db import transaction
+
+from .models import Artist, PlaylistSong, Song, UserPlaylist
+
+BATCH_SIZE = 500
+CHUNK_SIZE = 1000  # Synced tracks written per ingest_songs call
+
+# Song fields filled in from Spotify when they're blank; values already stored are never overwritten
+BACKFILLED_FIELDS = ["song_title", "artist", "album", "duration", "image_url", "spotify_uri"]
+# Compared through the artist's key so checking existing songs doesn't fetch their Artist
+BACKFILLED_ATTNAMES = ["song_title", "artist_id", "album", "duration", "image_url", "spotify_uri"]
+
+
+def ingest_songs(tracks: Iterable[dict]) -> dict[str, Song]:
+    """Create or backfill the artists and songs of <tracks> in bulk; return the Song of every ingested ISRC, in the
+    order they first appear in <tracks>.
+
+    Each track is a dict with the keys: isrc, song_title, artist_spotify_id, artist_name, album, duration, image_url
+    and spotify_uri. Tracks without an ISRC are skipped, and only the first track of each ISRC is used.
+
+    However many tracks there are, this takes one (batched) query each to upsert the artists, look up existing
+    songs, create new songs and backfill the blank fields of existing ones.
+    """
+    tracks_by_isrc = {}
+
+    for track in tracks:
+        if track.get("isrc"):
+            tracks_by_isrc.setdefault(track["isrc"], track)
+
+    if not tracks_by_isrc:
+        return {}
+
+    ingest_artists(tracks_by_isrc.values())
+
+    songs = Song.objects.in_bulk(list(tracks_by_isrc))
+    new_songs = []
+    changed_songs = []
+
+    for isrc, track in tracks_by_isrc.items():
+        song = songs.get(isrc)
+
+        if song is None:
+            song = Song(isrc=isrc)
+            songs[isrc] = song
+            new_songs.append(song)
+            _backfill(song, track)
+        elif _backfill(song, track):
+            changed_songs.append(song)
+
+    # A song created concurrently since the lookup above gets our values instead of failing the whole insert
+    Song.objects.bulk_create(new_songs, batch_size=BATCH_SIZE, update_conflicts=True, unique_fields=["isrc"],
+                             update_fields=BACKFILLED_FIELDS)
+    Song.objects.bulk_update(changed_songs, BACKFILLED_FIELDS, batch_size=BATCH_SIZE)
+
+    return {isrc: songs[isrc] for isrc in tracks_by_isrc}  # In the order of <tracks>
+
+
+def ingest_playlists(spotify_profile, playlists: list[dict]) -> list[UserPlaylist]:
+    """Create or update the UserPlaylists of <playlists> (Spotify playlist objects) for <spotify_profile> in bulk.
+
+    Playlists are matched on their Spotify ID, so a renamed playlist keeps its songs and snapshot. Returns one
+    UserPlaylist per playlist, in the same order.
+    """
+    stored = {
+        playlist.spotify_id: playlist
+        for playlist in spotify_profile.user_playlists.filter(spotify_id__in=[playlist["id"] for playlist in playlists])
+    }
+    new_playlists = []
+    changed_playlists = []
+    user_playlists = []
+
+    for playlist in playlists:
+        image_url = playlist["images"][0]["url"] if playlist.get("images") else ""
+        user_playlist = stored.get(playlist["id"])
+
+        if user_playlist is None:
+            user_playlist = UserPlaylist(spotify_user=spotify_profile, spotify_id=playlist["id"],
+                                         playlist_name=playlist["name"], image_url=image_url)
+            stored[playlist["id"]] = user_playlist
+            new_playlists.append(user_playlist)
+        elif (user_playlist.playlist_name, user_playlist.image_url) != (playlist["name"], image_url):
+            user_playlist.playlist_name = playlist["name"]
+            user_playlist.image_url = image_url
+            changed_playlists.append(user_playlist)
+
+        user_playlists.append(user_playlist)
+
+    UserPlaylist.objects.bulk_create(new_playlists, batch_size=BATCH_SIZE)
+    UserPlaylist.objects.bulk_update(changed_playlists, ["playlist_name", "image_url"], batch_size=BATCH_SIZE)
+
+    return user_playlists
+
+
+def ingest_playlist_pages(pages: Iterable[list[dict]], chunk_size: int = CHUNK_SIZE) -> list[PlaylistSong]:
+    """Ingest the tracks of <pages> (lists of track dicts, as yielded while syncing) in chunks of <chunk_size>.
+
+    Each track dict is as for <ingest_songs>, plus its "playlist_instance" and "order". Returns the playlist entries
+    of every ingested track as unsaved PlaylistSongs for <reconcile_playlist_songs>. They reference songs by ISRC
+    only, so once a chunk is written the only thing kept of its tracks is that (playlist, ISRC, order) triple.
+    """
+    playlist_songs = []
+    chunk = []
+
+    for page in pages:
+        chunk.extend(page)
+
+        if len(chunk) >= chunk_size:
+            playlist_songs.extend(_ingest_playlist_chunk(chunk))
+            chunk = []
+
+    playlist_songs.extend(_ingest_playlist_chunk(chunk))
+
+    return playlist_songs
+
+
+def _ingest_playlist_chunk(tracks: list[dict]) -> list[PlaylistSong]:
+    songs = ingest_songs(tracks)
+
+    return [
+        PlaylistSong(playlist=track["playlist_instance"], song_id=track["isrc"], order=track["order"])
+        for track in tracks
+        if track["isrc"] in songs  # e.g. no ISRC
+    ]
+
+
+def reconcile_playlist_songs(playlists, playlist_songs: Iterable[PlaylistSong]) -> dict[str, int]:
+    """Make the stored songs of <playlists> match <playlist_songs>, writing only what changed.
+
+    Stored (playlist, song) pairs that aren't in <playlist_songs> are deleted, new ones are created and those that
+    moved get their order updated, all in one transaction. A song appearing in a playlist more than once keeps its
+    first position. Returns how many rows were created, updated and deleted.
+    """
+    incoming = {}
+
+    for playlist_song in playlist_songs:
+        incoming.setdefault((playlist_song.playlist_id, playlist_song.song_id), playlist_song)
+
+    with transaction.atomic():
+        stored = {
+            (playlist_song.playlist_id, playlist_song.song_id): playlist_song
+            for playlist_song in PlaylistSong.objects.filter(playlist__in=playlists).only("playlist", "song", "order")
+        }
+
+        to_delete = [playlist_song.id for key, playlist_song in stored.items() if key not in incoming]
+        to_create = [playlist_song for key, playlist_song in incoming.items() if key not in stored]
+        to_update = []
+
+        for key, playlist_song in incoming.items():
+            if key in stored and stored[key].order != playlist_song.order:
+                stored[key].order = playlist_song.order
+                to_update.append(stored[key])
+
+        PlaylistSong.objects.filter(id__in=to_delete).delete()
+        PlaylistSong.objects.bulk_update(to_update, ["order"], batch_size=BATCH_SIZE)
+        PlaylistSong.objects.bulk_create(to_create, batch_size=BATCH_SIZE)
+
+    return {"created": len(to_create), "updated": len(to_update), "deleted": len(to_delete)}
+
+
+def ingest_artists(tracks: Iterable[dict]) -> None:
+    """Create the artists of <tracks>, updating the names of those that already exist"""
+    artists = {
+        track["artist_spotify_id"]: Artist(spotify_id=track["artist_spotify_id"], artist_name=track["artist_name"])
+        for track in tracks
+        if track.get("artist_spotify_id")
+    }
+
+    Artist.objects.bulk_create(list(artists.values()), batch_size=BATCH_SIZE, update_conflicts=True,
+                               unique_fields=["spotify_id"], update_fields=["artist_name"])
+
+
+def _backfill(song: Song, track: dict) -> bool:
+    """Fill in the blank fields of <song> from <track>; return whether anything changed"""
+    before = [getattr(song, attname) for attname in BACKFILLED_ATTNAMES]
+
+    if not song.song_title:
+        song.song_title = track["song_title"]
+
+    if not song.artist_id:
+        song.artist_id = track.get("artist_spotify_id")
+
+    if not song.album:
+        song.album = track["album"]
+
+    if not song.duration:
+        song.duration = track["duration"]
+
+    if not song.image_url:
+        song.image_url = track["image_url"]
+
+    if not song.spotify_uri:
+        song.spotify_uri = track["spotify_uri"]
+
+    return before != [getattr(song, attname) for attname in BACKFILLED_ATTNAMES]
@@ -0,0 +1,74 @@
+import time
+from datetime import timedelta
+
+from django.db import DatabaseError, connection
+from django.utils import timezone
+
+from .analysis import analyse_songs, analysed_vector
+from .models import AnalysisJob
+
+DEFAULT_BATCH_SIZE = 16
+DEFAULT_POLL_INTERVAL = 2  # seconds
+DEFAULT_RATE_LIMIT_DELAY = 5
+ERROR_DELAY = timedelta(seconds=30)  # Before the jobs of a batch that broke off are retried
+
+
+def run_worker(worker_name: str, batch_size: int = DEFAULT_BATCH_SIZE,
+               poll_interval: float = DEFAULT_POLL_INTERVAL) -> None:
+    """Claim and run analysis jobs until interrupted"""
+    print(f"[{worker_name}] Waiting for analysis jobs")
+
+    while True:
+        try:
+            AnalysisJob.release_stale()
+            jobs = AnalysisJob.claim(worker_name, batch_size)
+        except DatabaseError as e:
+            # e.g. "database is locked"; nothing was claimed, so just try again
+            print(f"[{worker_name}] Couldn't claim analysis jobs: {e!r}")
+            jobs = []
+
+        if not jobs:
+            connection.close()  # Don't hold a connection open while idle
+            time.sleep(poll_interval)
+            continue
+
+        print(f"[{worker_name}] Claimed {len(jobs)} analysis jobs")
+
+        try:
+            process_jobs(jobs)
+        except Exception as e:
+            # Keep the worker alive, and hand the batch back now rather than after ANALYSIS_JOB_TIMEOUT
+            print(f"[{worker_name}] Analysis batch failed: {e!r}")
+            release_jobs(jobs, worker_name)
+
+
+def process_jobs(jobs: list[AnalysisJob]) -> None:
+    """Analyse the songs of <jobs> concurrently and record each job's outcome"""
+    results = analyse_songs([job.song for job in jobs])
+    current_time = timezone.now()
+
+    for job, result in zip(jobs, results):
+        if analysed_vector(result) is not None:
+            job.status = AnalysisJob.DONE
+            job.finished_at = current_time
+        elif result and result[0] == 429:
+            # Still rate-limited after the engine's own retries; put it back for later
+            job.status = AnalysisJob.PENDING
+            job.run_after = current_time + timedelta(seconds=result[1] or DEFAULT_RATE_LIMIT_DELAY)
+            job.claimed_by = ""
+            job.claimed_at = None
+        else:
+            job.status = AnalysisJob.FAILED
+            job.finished_at = current_time
+
+    AnalysisJob.objects.bulk_update(jobs, ["status", "run_after", "claimed_by", "claimed_at", "finished_at"])
+
+
+def release_jobs(jobs: list[AnalysisJob], worker_name: str) -> None:
+    connection.close()  # The error may have left the connection unusable (e.g. mid-transaction)
+
+    try:
+        AnalysisJob.release(jobs, worker_name, ERROR_DELAY)
+    except DatabaseError as e:
+        # They're still re-queued by <AnalysisJob.release_stale> once ANALYSIS_JOB_TIMEOUT passes
+        print(f"[{worker_name}] Couldn't release analysis jobs: {e!r}")
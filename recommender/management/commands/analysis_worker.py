@@ -0,0 +1,63 @@
+import multiprocessing
+import os
+import socket
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+
+class Command(BaseCommand):
+    help = "Run background audio analysis workers that process queued AnalysisJobs."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--processes", type=int, default=1, help="Number of worker processes to run")
+        parser.add_argument("--batch-size", type=int, default=16,
+                            help="Jobs each process claims (and analyses concurrently) at a time")
+        parser.add_argument("--poll-interval", type=float, default=2, help="Seconds to wait when the queue is empty")
+
+    def handle(self, *args, **options):
+        num_processes = options["processes"]
+        worker_options = (options["batch_size"], options["poll_interval"])
+
+        if num_processes == 1:
+            _run_process(_worker_name(0), *worker_options)
+            return
+
+        # Children open their own connections; don't let them inherit ours
+        connections.close_all()
+
+        context = multiprocessing.get_context("spawn")
+        processes = [
+            context.Process(target=_run_process, args=(_worker_name(i), *worker_options), daemon=True)
+            for i in range(num_processes)
+        ]
+
+        for process in processes:
+            process.start()
+
+        self.stdout.write(f"Started {num_processes} analysis workers")
+
+        try:
+            for process in processes:
+                process.join()
+        except KeyboardInterrupt:
+            for process in processes:
+                process.terminate()
+
+
+def _worker_name(index: int) -> str:
+    return f"{socket.gethostname()}:{os.getpid()}:{index}"
+
+
+def _run_process(worker_name: str, batch_size: int, poll_interval: float) -> None:
+    # Spawned processes start from a fresh interpreter, so Django has to be set up before touching any models
+    import django
+
+    django.setup()
+
+    from recommender.jobs import run_worker
+
+    try:
+        run_worker(worker_name, batch_size=batch_size, poll_interval=poll_interval)
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,75 @@
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand
+
+from recommender import features
+from recommender.models import PreviewError, Song, SongFeatures, load_feature_vectors
+from recommender.preview_cache import get_preview_cache
+from recommender.transcoding import get_transcoder
+
+
+class Command(BaseCommand):
+    help = ("Benchmark the local feature extractor against stored ReccoBeats analyses: decode/extract throughput "
+            "and per-feature agreement.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--limit", type=int, default=100, help="Number of ReccoBeats-analysed songs to compare")
+        parser.add_argument("--batch-size", type=int, default=16, help="Songs decoded and extracted per batch")
+
+    def handle(self, *args, **options):
+        songs = list(
+            Song.objects.filter(features__extractor_version=SongFeatures.RECCOBEATS)[:options["limit"]]
+        )
+
+        # Fetch the audio up front so network time doesn't count towards the extractor's throughput
+        preview_cache = get_preview_cache()
+        audio = []
+        compared_songs = []
+
+        for song in songs:
+            data = preview_cache.read(song.isrc) if preview_cache else None
+
+            try:
+                audio.append(data if data is not None else song.download_preview())
+                compared_songs.append(song)
+            except PreviewError as e:
+                self.stderr.write(f"Skipping {song}: {e}")
+
+        if not compared_songs:
+            self.stdout.write("No ReccoBeats-analysed songs with an available preview to compare against.")
+            return
+
+        transcoder = get_transcoder()
+        command = transcoder.build_pcm_command(features.SAMPLE_RATE)
+        batch_size = options["batch_size"]
+        local_results = []
+
+        start_time = time.perf_counter()
+
+        for i in range(0, len(audio), batch_size):
+            # Decode the whole batch concurrently on the ffmpeg pool, then extract it in one vectorized pass
+            futures = [transcoder.submit(data, command) for data in audio[i:i + batch_size]]
+            signals = [np.frombuffer(future.result().data, dtype=np.float32) for future in futures]
+            local_results.extend(features.extract_batch(signals))
+
+        elapsed = time.perf_counter() - start_time
+
+        local = np.array([[result[name] for name in features.FEATURE_NAMES] for result in local_results])
+        found, vectors = load_feature_vectors(song.isrc for song in compared_songs)
+        stored = dict(zip(found, vectors))
+        reccobeats = np.array([stored[song.isrc] for song in compared_songs])
+
+        self.stdout.write(f"Analysed {len(compared_songs)} songs in {elapsed:.2f}s "
+                          f"({len(compared_songs) / elapsed:.1f} songs/s)\n")
+        self.stdout.write(f"{'feature':<18}{'MAE':>10}{'pearson r':>12}")
+
+        for j, name in enumerate(features.FEATURE_NAMES):
+            mae = np.mean(np.abs(local[:, j] - reccobeats[:, j]))
+
+            if len(compared_songs) > 1 and np.std(local[:, j]) > 0 and np.std(reccobeats[:, j]) > 0:
+                correlation = f"{np.corrcoef(local[:, j], reccobeats[:, j])[0, 1]:.3f}"
+            else:
+                correlation = "n/a"
+
+            self.stdout.write(f"{name:<18}{mae:>10.3f}{correlation:>12}")
@@ -0,0 +1,66 @@
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand
+from sklearn.metrics.pairwise import cosine_similarity
+
+from recommender.features import FEATURE_NAMES
+from recommender.scoring import DEFAULT_TOP_K, MAX, MEAN, SCORING_MODES, TOP_K, score_candidates, top_n
+
+
+class Command(BaseCommand):
+    help = ("Benchmark a scoring mode against the full cosine similarity matrix on synthetic feature vectors, "
+            "e.g. for a user who picked several 1,000-track playlists.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--playlists", type=int, default=5, help="Number of user playlists")
+        parser.add_argument("--tracks", type=int, default=1000, help="Tracks per playlist")
+        parser.add_argument("--candidates", type=int, default=20000, help="Number of candidate songs")
+        parser.add_argument("--top", type=int, default=200, help="Number of recommendations to rank")
+        parser.add_argument("--mode", choices=SCORING_MODES, default=MEAN, help="Scoring mode to benchmark")
+        parser.add_argument("--k", type=int, default=DEFAULT_TOP_K, help="k for the topk scoring mode")
+        parser.add_argument("--repeat", type=int, default=5, help="Runs per engine; the fastest is reported")
+
+    def handle(self, *args, **options):
+        rng = np.random.default_rng(0)
+        user_vectors = rng.random((options["playlists"] * options["tracks"], len(FEATURE_NAMES)))
+        candidate_vectors = rng.random((options["candidates"], len(FEATURE_NAMES)))
+        top = options["top"]
+        mode = options["mode"]
+        k = options["k"]
+
+        aggregations = {
+            MEAN: lambda similarities: similarities.mean(),
+            MAX: lambda similarities: similarities.max(),
+            TOP_K: lambda similarities: np.sort(similarities)[-k:].mean(),
+        }
+
+        def full_matrix():
+            similarity_scores = cosine_similarity(candidate_vectors, user_vectors)
+            scores = np.array([aggregations[mode](similarity_scores[i]) for i in range(len(candidate_vectors))])
+            return scores, np.argsort(-scores, kind="stable")[:top]
+
+        def engine():
+            scores = score_candidates(candidate_vectors, user_vectors, mode, k)
+            return scores, top_n(scores, top)
+
+        self.stdout.write(f"{len(candidate_vectors)} candidates x {len(user_vectors)} user songs, "
+                          f"{mode} scoring, top {top}\n")
+
+        results = {}
+
+        for name, run in [("full matrix", full_matrix), (mode, engine)]:
+            timings = []
+
+            for _ in range(options["repeat"]):
+                start_time = time.perf_counter()
+                results[name] = run()
+                timings.append(time.perf_counter() - start_time)
+
+            self.stdout.write(f"{name:<14}{min(timings) * 1000:>10.1f} ms")
+
+        baseline_scores, baseline_top = results["full matrix"]
+        scores, ranked = results[mode]
+
+        self.stdout.write(f"\nmax score difference: {np.max(np.abs(scores - baseline_scores)):.2e}")
+        self.stdout.write(f"top {top} overlap: {len(np.intersect1d(ranked, baseline_top))}/{len(baseline_top)}")
@@ -0,0 +1,31 @@
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+
+from recommender.feature_matrix import get_feature_matrix
+from recommender.models import SongFeatures, unpack_vectors
+
+
+class Command(BaseCommand):
+    help = "Rebuild the memory-mapped feature matrix from every SongFeatures row in the database."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=10000, help="Rows read from the database per query")
+
+    def handle(self, *args, **options):
+        feature_matrix = get_feature_matrix()
+
+        if feature_matrix is None:
+            raise CommandError("FEATURE_MATRIX_DIR is not set.")
+
+        isrcs = []
+        chunks = []
+        rows = SongFeatures.objects.order_by("song_id").values_list("song_id", "vector")
+
+        for start in range(0, rows.count(), options["chunk_size"]):
+            chunk = list(rows[start:start + options["chunk_size"]])
+            isrcs.extend(isrc for isrc, vector in chunk)
+            chunks.append(unpack_vectors(vector for isrc, vector in chunk))
+
+        feature_matrix.rebuild(isrcs, np.vstack(chunks) if chunks else unpack_vectors([]))
+
+        self.stdout.write(f"Stored {len(isrcs)} feature vectors in {feature_matrix.matrix_path}")
@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:12
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recommender', '0011_alter_song_album_alter_song_image_url'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AnalysisFailure',
+            fields=[
+                ('song', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='analysis_failure', serialize=False, to='recommender.song')),
+                ('reason', models.CharField(choices=[('no_preview', 'No Deezer preview'), ('download_failed', 'Preview download failed'), ('transcode_failed', 'Transcoding failed'), ('rejected', 'Rejected by ReccoBeats')], max_length=30)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('last_failed', models.DateTimeField(default=django.utils.timezone.now)),
+                ('retry_after', models.DateTimeField(db_index=True)),
+            ],
+        ),
+    ]
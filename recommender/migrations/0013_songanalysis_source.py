@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recommender', '0012_analysisfailure'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='songanalysis',
+            name='source',
+            field=models.CharField(choices=[('reccobeats', 'ReccoBeats'), ('local', 'Local extractor')], default='reccobeats', max_length=20),
+        ),
+    ]
@@ -0,0 +1,67 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:19
+
+import django.db.models.deletion
+import numpy as np
+from django.db import migrations, models
+
+FEATURE_NAMES = ["acousticness", "danceability", "energy", "instrumentalness", "liveness", "loudness",
+                 "speechiness", "tempo", "valence"]
+
+# SongAnalysis.source -> SongFeatures.extractor_version
+EXTRACTOR_VERSIONS = {"reccobeats": "reccobeats", "local": "local-1"}
+
+
+def copy_song_analyses(apps, schema_editor):
+    Song = apps.get_model("recommender", "Song")
+    SongFeatures = apps.get_model("recommender", "SongFeatures")
+
+    songs = Song.objects.filter(analysis__isnull=False).select_related("analysis")
+
+    SongFeatures.objects.bulk_create([
+        SongFeatures(
+            song=song,
+            vector=np.array([getattr(song.analysis, name) for name in FEATURE_NAMES], dtype="<f4").tobytes(),
+            extractor_version=EXTRACTOR_VERSIONS[song.analysis.source],
+        )
+        for song in songs.iterator()
+    ], batch_size=1000)
+
+
+def copy_song_features(apps, schema_editor):
+    Song = apps.get_model("recommender", "Song")
+    SongAnalysis = apps.get_model("recommender", "SongAnalysis")
+    SongFeatures = apps.get_model("recommender", "SongFeatures")
+    sources = {version: source for source, version in EXTRACTOR_VERSIONS.items()}
+
+    for song_features in SongFeatures.objects.iterator():
+        values = np.frombuffer(bytes(song_features.vector), dtype="<f4").tolist()
+        analysis = SongAnalysis.objects.create(source=sources.get(song_features.extractor_version, "local"),
+                                               **dict(zip(FEATURE_NAMES, values)))
+        Song.objects.filter(isrc=song_features.song_id).update(analysis=analysis)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recommender', '0014_analysisjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SongFeatures',
+            fields=[
+                ('song', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='features', serialize=False, to='recommender.song')),
+                ('vector', models.BinaryField()),
+                ('extractor_version', models.CharField(db_index=True, max_length=30)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.RunPython(copy_song_analyses, copy_song_features),
+        migrations.RemoveField(
+            model_name='song',
+            name='analysis',
+        ),
+        migrations.DeleteModel(
+            name='SongAnalysis',
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:25
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recommender', '0015_songfeatures'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArtistTopTracks',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('market', models.CharField(blank=True, max_length=2)),
+                ('tracks', models.JSONField()),
+                ('fetched_at', models.DateTimeField()),
+                ('artist', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='top_tracks', to='recommender.artist')),
+            ],
+            options={
+                'unique_together': {('artist', 'market')},
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recommender', '0016_artisttoptracks'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userplaylist',
+            name='snapshot_id',
+            field=models.CharField(blank=True, max_length=200),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:33
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0007_userspotifyprofile_spotify_profile_image'),
+        ('recommender', '0017_userplaylist_snapshot_id'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SyncJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='pending', max_length=10)),
+                ('owned_only', models.BooleanField(default=False)),
+                ('selected_ids', models.JSONField(blank=True, null=True)),
+                ('playlists', models.JSONField(blank=True, default=list)),
+                ('playlists_total', models.PositiveIntegerField(default=0)),
+                ('playlists_synced', models.PositiveIntegerField(default=0)),
+                ('tracks_synced', models.PositiveIntegerField(default=0)),
+                ('reauth_required', models.BooleanField(default=False)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('spotify_user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='sync_jobs', to='accounts.userspotifyprofile')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(condition=models.Q(('status__in', ['pending', 'running'])), fields=('spotify_user',), name='unique_active_sync_job')],
+            },
+        ),
+    ]
@@ -1,18 +1,53 @@
-from django.db import models
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, models, transaction
+from django.utils import timezone
 from accounts.models import CustomUser, UserSpotifyProfile
+from . import features
+from .analysis import analyse_songs, analysed_vector, host_slot
+from .feature_matrix import get_feature_matrix
+from .features import FEATURE_DTYPE
+from .preview_cache import get_preview_cache
+from .ratelimit import block_host, limited_request, parseint, retry_after_seconds
+from .threads import closing_connection
+from .transcoding import STREAM_CHUNK_SIZE, TranscodeError, get_transcoder
+from utils.spotify_tokens import get_access_token
 
 import re
-import os
-
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import time
+import uuid
+from datetime import timedelta
+from typing import Iterable, Iterator
+
+import numpy as np
 import requests
 import aiohttp
 
-import ffmpeg
-import imageio_ffmpeg
-
 from requests.utils import requote_uri
 from io import BytesIO
 
+DEEZER_QUOTA_ERROR = 4
+DEEZER_QUOTA_BACKOFF = 5  # seconds; Deezer's quota is per 5 second window
+DEEZER_NO_DATA_ERROR = 800
+DEFAULT_DEEZER_PREVIEW_TTL = 60 * 60  # seconds
+DEFAULT_DEEZER_NO_PREVIEW_TTL = 24 * 60 * 60
+DEEZER_EXPIRY_MARGIN = 60
+DEFAULT_ANALYSIS_RETRY_BACKOFF = timedelta(hours=1)
+DEFAULT_ANALYSIS_RETRY_BACKOFF_MAX = timedelta(days=30)
+DEFAULT_ANALYSIS_JOB_FAILURE_COOLDOWN = timedelta(minutes=10)
+DEFAULT_ANALYSIS_JOB_TIMEOUT = timedelta(minutes=10)
+DEFAULT_ANALYSIS_JOB_MAX_ATTEMPTS = 3
+DEFAULT_ARTIST_TOP_TRACKS_TTL = timedelta(days=1)
+DEFAULT_ARTIST_TOP_TRACKS_STALE_TTL = timedelta(days=7)
+DEFAULT_SYNC_JOB_TIMEOUT = timedelta(minutes=10)
+ARTIST_TOP_TRACKS_REFRESH_TIMEOUT = 60  # seconds
+DEFAULT_ARTIST_TOP_TRACKS_REFRESH_WORKERS = 4
+
+_top_tracks_refresher = None
+_top_tracks_refresher_lock = threading.Lock()
+
 
 class Artist(models.Model):
     artist_name = models.CharField(max_length=200)
@@ -21,16 +56,47 @@ class Artist(models.Model):
     def __str__(self):
         return self.artist_name
 
-    def get_top_n_songs(self, spotify_profile, n: int = 40):
-        """Returns the top <n> songs by their respective identifying ISRC codes."""
+    def get_top_n_songs(self, spotify_profile, n: int = 40, market: str | None = None):
+        """Returns the top <n> songs by their respective identifying ISRC codes.
+
+        Served from <ArtistTopTracks> when possible: a fresh entry costs no Spotify call, and a stale one (up to
+        ARTIST_TOP_TRACKS_STALE_TTL old) is returned right away while a background thread refreshes it.
+        """
+        if market is None:
+            market = getattr(settings, "SPOTIFY_MARKET", None) or ""
+
+        cached = ArtistTopTracks.objects.filter(artist=self, market=market).first()
+
+        if cached and not cached.is_expired():
+            if cached.is_stale():
+                self.refresh_top_tracks_in_background(spotify_profile, market)
+
+            return {"tracks": self._with_artist(cached.tracks[:n]), "reauth_required": False, "status_code": 200}
 
+        top_tracks = self.fetch_top_tracks(spotify_profile, market)
+
+        if top_tracks["status_code"] == 200:
+            top_tracks["tracks"] = self._with_artist(top_tracks["tracks"][:n])
+
+        return top_tracks
+
+    def fetch_top_tracks(self, spotify_profile, market: str = ""):
+        """Fetch this artist's top tracks from Spotify and save them to <ArtistTopTracks>"""
         spotify_api_url = (
             f"https://api.spotify.com/v1/artists/{self.spotify_id}/top-tracks"
         )
 
-        headers = {"Authorization": f"Bearer {spotify_profile.access_token}"}
+        if market:
+            spotify_api_url += f"?market={market}"
+
+        access_token = get_access_token(spotify_profile)
 
-        response = requests.get(url=spotify_api_url, headers=headers)
+        if access_token is None:
+            return {"reauth_required": True, "status_code": 401}
+
+        headers = {"Authorization": f"Bearer {access_token}"}
+
+        response = limited_request("GET", url=spotify_api_url, headers=headers)
 
         if response.status_code == 401:
             return {"reauth_required": True, "status_code": response.status_code}
@@ -39,19 +105,18 @@ class Artist(models.Model):
 
         track_list = []
 
-        for track in response.json()["tracks"][:n]:
+        for track in response.json()["tracks"]:
 
             if track["is_local"]:
                 continue
 
             try:
                 image_url = track["album"]["images"][0]["url"]
-            except KeyError or IndexError:
+            except (KeyError, IndexError):
                 image_url = ""
 
             track_data = {
                 "title": track["name"],
-                "artist": self,
                 "album": track["album"]["name"],
                 "image_url": image_url,
                 "duration": track["duration_ms"],
@@ -61,24 +126,61 @@ class Artist(models.Model):
 
             track_list.append(track_data)
 
+        ArtistTopTracks.objects.update_or_create(artist=self, market=market,
+                                                 defaults={"tracks": track_list, "fetched_at": timezone.now()})
+
         return {"tracks": track_list, "reauth_required": False, "status_code": 200}
 
+    def refresh_top_tracks_in_background(self, spotify_profile, market: str = "") -> None:
+        # Only one refresh per artist and market at a time, across every process
+        lock_key = f"artist-top-tracks:{self.spotify_id}:{market}:refreshing"
+
+        if not cache.add(lock_key, True, ARTIST_TOP_TRACKS_REFRESH_TIMEOUT):
+            return
+
+        @closing_connection
+        def refresh():
+            try:
+                self.fetch_top_tracks(spotify_profile, market)
+            except requests.exceptions.RequestException as e:
+                print(f"Failed to refresh top tracks of {self}: {e}")
+            finally:
+                cache.delete(lock_key)
+
+        get_top_tracks_refresher().submit(refresh)
+
+    def _with_artist(self, tracks: list[dict]) -> list[dict]:
+        return [{**track, "artist": self} for track in tracks]
+
+
+class ArtistTopTracks(models.Model):
+    """An artist's parsed Spotify top tracks in a market, cached by <Artist.get_top_n_songs>.
+
+    Instance Attributes:
+        - tracks: The track dicts returned by <Artist.fetch_top_tracks>
+        - fetched_at: When <tracks> were fetched; fresh for ARTIST_TOP_TRACKS_TTL, then served stale (and refreshed
+          in the background) until ARTIST_TOP_TRACKS_STALE_TTL
+    """
+
+    artist = models.ForeignKey(Artist, on_delete=models.CASCADE, related_name="top_tracks")
+    market = models.CharField(max_length=2, blank=True)  # "" when no market was requested
+    tracks = models.JSONField()
+    fetched_at = models.DateTimeField()
+
+    class Meta:
+        unique_together = ("artist", "market")
+
+    def __str__(self):
+        return f"{self.artist}: {self.market or 'any market'}"
 
-class SongAnalysis(models.Model):
-    # ReccoBeats Analysis Features
-    acousticness = models.FloatField()
-    danceability = models.FloatField()
-    energy = models.FloatField()
-    instrumentalness = models.FloatField()
-    liveness = models.FloatField()
-    loudness = models.FloatField()
-    speechiness = models.FloatField()
-    tempo = models.FloatField()
-    valence = models.FloatField()
+    def age(self) -> timedelta:
+        return timezone.now() - self.fetched_at
 
-    def to_list(self):
-        return [self.acousticness, self.danceability, self.energy, self.instrumentalness,
-                self.liveness, self.loudness, self.speechiness, self.tempo, self.valence]
+    def is_stale(self) -> bool:
+        return self.age() > getattr(settings, "ARTIST_TOP_TRACKS_TTL", DEFAULT_ARTIST_TOP_TRACKS_TTL)
+
+    def is_expired(self) -> bool:
+        return self.age() > getattr(settings, "ARTIST_TOP_TRACKS_STALE_TTL", DEFAULT_ARTIST_TOP_TRACKS_STALE_TTL)
 
 
 class Song(models.Model):
@@ -90,78 +192,143 @@ class Song(models.Model):
     spotify_uri = models.CharField(max_length=300, blank=True)
     image_url = models.URLField(blank=True)
 
-    analysis = models.ForeignKey(SongAnalysis, null=True, blank=True, on_delete=models.SET_NULL)
-
     def __str__(self):
         return self.song_title
 
     def get_deezer_preview(self) -> str | None:
+        # Deezer lookups are cached per ISRC, including definitive "no preview" answers (cached as "")
+        cache_key = f"deezer:preview:{self.isrc}"
+        cached = cache.get(cache_key)
+
+        if cached is not None:
+            return cached or None
+
         base_url = "https://api.deezer.com/track/"
         query = requote_uri(f"isrc:{self.isrc}")
         deezer_url = base_url + query
 
-        response = requests.get(deezer_url)
+        with host_slot(deezer_url):
+            response = limited_request("GET", deezer_url)
         response.raise_for_status()
         data = response.json()
 
+        error = data.get("error")
+
+        # Deezer signals its rate limit as a "quota exceeded" error rather than a 429
+        if error and error.get("code") == DEEZER_QUOTA_ERROR:
+            block_host(deezer_url, DEEZER_QUOTA_BACKOFF)
+            raise AnalysisRateLimited(DEEZER_QUOTA_BACKOFF)
+
+        # Deezer reports errors with a 200 status; only "no data" (code 800) means the track truly isn't there.
+        # Anything else (e.g. service busy) is transient, so don't remember it.
+        if error and error.get("code") != DEEZER_NO_DATA_ERROR:
+            raise AnalysisUnavailable(f"Deezer error {error.get('code')}: {error.get('message')}")
+
         items = data.get("preview", {})
 
         if items:
+            ttl = deezer_preview_ttl(items)
+
+            if ttl > 0:
+                cache.set(cache_key, items, ttl)
+
             return items
 
+        cache.set(cache_key, "", getattr(settings, "DEEZER_NO_PREVIEW_TTL", DEFAULT_DEEZER_NO_PREVIEW_TTL))
         return None
 
-    def reencode_preview_url(self) -> BytesIO:
-        # Add imageio-ffmpeg binary to PATH
-        os.environ["PATH"] = (
-                os.path.dirname(imageio_ffmpeg.get_ffmpeg_exe())
-                + os.pathsep
-                + os.environ["PATH"]
-        )
-
+    def download_preview(self) -> bytes:
+        """Return the Deezer preview of this song as downloaded, raising PreviewError if it isn't available"""
         preview_url = self.get_deezer_preview()
 
         if not preview_url:
-            raise ValueError("No preview URL available from Deezer!")
+            raise PreviewError("No preview URL available from Deezer!", AnalysisFailure.NO_PREVIEW)
 
         # Download preview into variable
-        response = requests.get(preview_url)
-        if (
+        with host_slot(preview_url):
+            response = limited_request("GET", preview_url)
+        if response.status_code >= 500:
+            raise AnalysisUnavailable(f"Deezer responded with {response.status_code}")
+        elif (
                 response.status_code != 200
-        ):  # Raise ValueError if preview could not be downloaded from the url
-            raise ValueError("Failed to download preview")
-
-        preview_bytes = BytesIO(
-            response.content
-        )  # Keep response in memory with BytesIO; avoid writing to disk (no .mp3 files)
-
-        # Re-encode using ffmpeg-python; fixes bit-rate issue from Deezer previews
-        process = (
-            ffmpeg.input("pipe:0")
-            .output("pipe:1", format="mp3", audio_bitrate="192k", ac=2, ar=44100)
-            .run_async(pipe_stdin=True, pipe_stdout=True, pipe_stderr=True)
-        )
+        ):  # Raise PreviewError if preview could not be downloaded from the url
+            raise PreviewError("Failed to download preview", AnalysisFailure.DOWNLOAD_FAILED)
 
-        out, err = process.communicate(
-            input=preview_bytes.read()
-        )  # out: output from process; err: possible errors from process
+        return response.content
 
-        if process.returncode != 0:
-            raise RuntimeError("ffmpeg failed:\n" + err.decode())
+    def reencode_preview_url(self) -> BytesIO:
+        preview_cache = get_preview_cache()
+
+        # Previously transcoded (e.g. ReccoBeats failed last time); skip both the Deezer download and ffmpeg
+        if preview_cache and (cached := preview_cache.read(self.isrc)) is not None:
+            return BytesIO(cached)
+
+        # Re-encode on the shared ffmpeg pool; fixes bit-rate issue from Deezer previews
+        transcoded = get_transcoder().transcode(self.download_preview())
+
+        print(f"Transcoded {self.song_title} in {transcoded.transcode_seconds:.2f}s "
+              f"(queued {transcoded.queued_seconds:.2f}s)")
 
-        result = BytesIO(out)  # Final fixed preview with enhanced bitrate
+        if preview_cache:
+            preview_cache.put(self.isrc, transcoded.data)
+
+        result = BytesIO(transcoded.data)  # Final fixed preview with enhanced bitrate
         result.seek(0)
         return result
 
-    def set_song_analysis(self):
+    def stream_preview(self) -> Iterator[bytes]:
+        """Streaming counterpart of <reencode_preview_url>: return an iterator over the re-encoded preview.
+
+        The download is piped into ffmpeg chunk by chunk as it arrives and the output is yielded as ffmpeg produces
+        it, so the preview is never held in memory in full.
+        """
+        preview_cache = get_preview_cache()
+
+        if preview_cache and (cached := preview_cache.iter_chunks(self.isrc)) is not None:
+            return cached
+
+        preview_url = self.get_deezer_preview()
+
+        if not preview_url:
+            raise PreviewError("No preview URL available from Deezer!", AnalysisFailure.NO_PREVIEW)
+
+        with host_slot(preview_url):
+            response = limited_request("GET", preview_url, stream=True)  # Only the headers have been read at this point
 
-        if self.analysis:
-            return 200, self.analysis.to_list()
+        if response.status_code != 200:
+            response.close()
 
-        # else:
+            if response.status_code >= 500:
+                raise AnalysisUnavailable(f"Deezer responded with {response.status_code}")
+
+            raise PreviewError("Failed to download preview", AnalysisFailure.DOWNLOAD_FAILED)
+
+        stream = get_transcoder().stream(iter_response_content(response))
+
+        if preview_cache:
+            return preview_cache.tee(self.isrc, stream)
+
+        return stream
+
+    def get_reccobeats_analysis(self) -> dict:
+        """Upload this song's preview to ReccoBeats and return the features it reports.
+
+        Raises AnalysisRateLimited if ReccoBeats rate-limited the upload, AnalysisUnavailable if it had a server error
+        and AnalysisRejected if it refused it.
+        """
         reccobeats_url = "https://api.reccobeats.com/v1/analysis/audio-features"
+        headers = {"Accept": "application/json"}
 
-        try:
+        if getattr(settings, "ANALYSIS_STREAMING", False):
+            # Upload the transcoder's output as it's produced, using a chunked multipart body
+            boundary = uuid.uuid4().hex
+            headers["Content-Type"] = f"multipart/form-data; boundary={boundary}"
+            body = iter_multipart_file("audioFile", "preview.mp3", "audio/mpeg",
+                                       self.stream_preview(), boundary)
+
+            with host_slot(reccobeats_url):
+                analysis = limited_request("POST", url=reccobeats_url, max_retries=0, headers=headers, data=body)
+        else:
             song_data = self.reencode_preview_url()
 
             files = {
@@ -172,40 +339,371 @@ class Song(models.Model):
                 )
             }
 
-            headers = {"Accept": "application/json"}
+            # The upload can't be replayed once <song_data> is consumed, so rate limits are retried by the caller
+            with host_slot(reccobeats_url):
+                analysis = limited_request("POST", url=reccobeats_url, max_retries=0, headers=headers, files=files)
+
+        print(analysis.text)
+        print(analysis.status_code)
+
+        if analysis.status_code == 429:
+            raise AnalysisRateLimited(retry_after_seconds(analysis))
+        elif analysis.status_code >= 500:
+            raise AnalysisUnavailable(f"ReccoBeats responded with {analysis.status_code}")
+        elif analysis.status_code != 200:
+            raise AnalysisRejected(f"ReccoBeats responded with {analysis.status_code}")
+
+        return analysis.json()
+
+    def get_local_analysis(self) -> dict:
+        """Compute this song's features locally from its preview, without any analysis service"""
+        preview_cache = get_preview_cache()
+        audio = preview_cache.read(self.isrc) if preview_cache else None
+
+        if audio is None:
+            audio = self.download_preview()
 
-            analysis = requests.post(url=reccobeats_url, headers=headers, files=files)
-            print(analysis.text)
-            print(analysis.status_code)
+        signal = get_transcoder().decode_pcm(audio, features.SAMPLE_RATE)
+        return features.extract_features(signal)
 
-            if analysis.status_code not in {200, 429}:
+    def set_song_analysis(self):
+        """Analyse this song and save the result, trying each of settings.ANALYSIS_BACKENDS in order.
+
+        Returns (200, feature_vector) on success, (429, retry_seconds) when a backend was rate-limited and none of
+        the others succeeded (retry_seconds may be None), or None if the song can't be analysed.
+        """
+
+        try:
+            return 200, self.features.to_list()
+        except SongFeatures.DoesNotExist:
+            pass
+
+        # Backend name -> (analysis function, extractor version its vectors are stored under)
+        backends = {
+            "reccobeats": (self.get_reccobeats_analysis, SongFeatures.RECCOBEATS),
+            "local": (self.get_local_analysis, features.EXTRACTOR_VERSION),
+        }
+
+        rate_limited = None
+        unavailable = False
+        failure_reason = None
+
+        for backend in getattr(settings, "ANALYSIS_BACKENDS", ["reccobeats"]):
+            analyse, extractor_version = backends[backend]
+
+            try:
+                data = analyse()
+            except AnalysisRateLimited as e:
+                rate_limited = e
+                continue
+            except (AnalysisUnavailable, requests.exceptions.RequestException) as e:
+                # e.g. a 5xx, or the provider couldn't be reached at all; the next backend may still manage
+                print(e)
+                unavailable = True
+                continue
+            except AnalysisRejected as e:
                 print("ReccoBeats Analysis Error; Song Skipped.")
-                return None
-            else:
-                data = analysis.json()
-
-                if analysis.status_code == 200:
-                    song_analysis, created = SongAnalysis.objects.get_or_create(
-                        acousticness=data["acousticness"],
-                        danceability=data["danceability"],
-                        energy=data["energy"],
-                        instrumentalness=data["instrumentalness"],
-                        liveness=data["liveness"],
-                        loudness=data["loudness"],
-                        speechiness=data["speechiness"],
-                        tempo=data["tempo"],
-                        valence=data["valence"]
-                    )
-
-                    self.analysis = song_analysis
-                    self.save()
-
-                return analysis.status_code, self.analysis.to_list()
-
-        except ValueError as e:
-            print("No Preview URL Found; Song skipped")
-            print(e)
-            return None
+                failure_reason = AnalysisFailure.REJECTED
+                continue
+            except PreviewError as e:
+                print("No Preview URL Found; Song skipped")
+                print(e)
+                failure_reason = e.reason
+                continue
+            except TranscodeError as e:
+                print(e)
+                failure_reason = AnalysisFailure.TRANSCODE_FAILED
+                continue
+
+            vector = [data[name] for name in features.FEATURE_NAMES]
+            self.features = SongFeatures.store(self, vector, extractor_version)
+
+            AnalysisFailure.objects.filter(song=self).delete()
+
+            return 200, self.features.to_list()
+
+        # A rate limit is only temporary, so let the caller retry rather than recording a failure
+        if rate_limited:
+            return 429, rate_limited.retry_seconds
+
+        # Only back off from songs that failed for a lasting reason; a server error may be gone on the next attempt
+        if failure_reason and not unavailable:
+            AnalysisFailure.record(self, failure_reason)
+
+        return None
+
+
+class SongFeatures(models.Model):
+    """The analysed features of a song, packed as little-endian float32 in <features.FEATURE_NAMES> order.
+
+    Instance Attributes:
+        - song: The analysed song; each ISRC has at most one row
+        - vector: The packed feature vector (see <pack_vector>)
+        - extractor_version: What produced <vector>: RECCOBEATS, or the local extractor's <features.EXTRACTOR_VERSION>
+    """
+
+    RECCOBEATS = "reccobeats"
+
+    song = models.OneToOneField(Song, primary_key=True, on_delete=models.CASCADE, related_name="features")
+    vector = models.BinaryField()
+    extractor_version = models.CharField(max_length=30, db_index=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.song_id}: {self.extractor_version}"
+
+    def to_list(self) -> list[float]:
+        return unpack_vectors([self.vector])[0].tolist()
+
+    @classmethod
+    def store(cls, song, vector, extractor_version: str) -> "SongFeatures":
+        song_features = cls(song=song, vector=pack_vector(vector), extractor_version=extractor_version)
+
+        # A single upsert statement rather than update_or_create's read-then-write transaction, which concurrent
+        # analysis threads would otherwise contend on (on SQLite, failing with "database is locked")
+        cls.objects.bulk_create([song_features], update_conflicts=True, unique_fields=["song"],
+                                update_fields=["vector", "extractor_version", "updated_at"])
+
+        feature_matrix = get_feature_matrix()
+
+        if feature_matrix is not None:
+            # Only publish the vector to other processes once it's actually in the database
+            transaction.on_commit(lambda: feature_matrix.append({song.isrc: song_features.to_list()}))
+
+        return song_features
+
+
+def pack_vector(vector) -> bytes:
+    """Return <vector> (a sequence of len(FEATURE_NAMES) numbers) as the bytes stored in <SongFeatures.vector>"""
+    return np.asarray(vector, dtype=FEATURE_DTYPE).tobytes()
+
+
+def unpack_vectors(blobs: Iterable) -> np.ndarray:
+    """Return the packed vectors in <blobs> as one (len(blobs) x len(FEATURE_NAMES)) float32 array"""
+    return np.frombuffer(b"".join(blobs), dtype=FEATURE_DTYPE).reshape(-1, len(features.FEATURE_NAMES))
+
+
+def load_feature_vectors(isrcs: Iterable[str]) -> tuple[list[str], np.ndarray]:
+    """Return the ISRCs in <isrcs> that have stored features, along with their vectors (one row each, same order).
+
+    Vectors are read from the shared <FeatureMatrix> when one is configured. Any that aren't in it yet are loaded
+    from the database in a single query, without instantiating any models, and added to the matrix. The database
+    stays the source of truth: the matrix has no way to remove rows, so vectors whose SongFeatures were deleted are
+    dropped here (and from the matrix itself at the next <build_feature_matrix>).
+    """
+    isrcs = list(isrcs)
+    feature_matrix = get_feature_matrix()
+
+    if feature_matrix is None:
+        return _query_feature_vectors(isrcs)
+
+    found, vectors = feature_matrix.vectors(isrcs)
+
+    if found:
+        # Only the keys; much cheaper than loading the vectors themselves
+        stored = set(SongFeatures.objects.filter(song__in=found).values_list("song_id", flat=True))
+        keep = np.fromiter((isrc in stored for isrc in found), dtype=bool, count=len(found))
+        found, vectors = [isrc for isrc in found if isrc in stored], vectors[keep]
+
+    missing = set(isrcs).difference(found)
+
+    if not missing:
+        return found, vectors
+
+    queried, queried_vectors = _query_feature_vectors(missing)
+    feature_matrix.append(dict(zip(queried, queried_vectors)))
+
+    return found + queried, np.vstack([vectors, queried_vectors])
+
+
+def _query_feature_vectors(isrcs: Iterable[str]) -> tuple[list[str], np.ndarray]:
+    rows = list(SongFeatures.objects.filter(song__in=list(isrcs)).values_list("song_id", "vector"))
+    found = [isrc for isrc, vector in rows]
+
+    return found, unpack_vectors(vector for isrc, vector in rows)
+
+
+class AnalysisFailure(models.Model):
+    """A song that recently failed analysis for a reason that retrying right away won't fix.
+
+    Songs are skipped by <run_analysis> until <retry_after>, which backs off exponentially with every consecutive
+    failure. Transient errors (rate limits, network errors) are never recorded here.
+    """
+
+    NO_PREVIEW = "no_preview"
+    DOWNLOAD_FAILED = "download_failed"
+    TRANSCODE_FAILED = "transcode_failed"
+    REJECTED = "rejected"
+
+    REASON_CHOICES = [
+        (NO_PREVIEW, "No Deezer preview"),
+        (DOWNLOAD_FAILED, "Preview download failed"),
+        (TRANSCODE_FAILED, "Transcoding failed"),
+        (REJECTED, "Rejected by ReccoBeats"),
+    ]
+
+    song = models.OneToOneField(Song, primary_key=True, on_delete=models.CASCADE, related_name="analysis_failure")
+    reason = models.CharField(max_length=30, choices=REASON_CHOICES)
+    attempts = models.PositiveIntegerField(default=0)
+    last_failed = models.DateTimeField(default=timezone.now)
+    retry_after = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return f"{self.song_id}: {self.reason} (retry after {self.retry_after})"
+
+    @classmethod
+    def record(cls, song, reason: str) -> "AnalysisFailure":
+        failure, created = cls.objects.get_or_create(song=song, defaults={"reason": reason,
+                                                                         "retry_after": timezone.now()})
+
+        base = getattr(settings, "ANALYSIS_RETRY_BACKOFF", DEFAULT_ANALYSIS_RETRY_BACKOFF)
+        maximum = getattr(settings, "ANALYSIS_RETRY_BACKOFF_MAX", DEFAULT_ANALYSIS_RETRY_BACKOFF_MAX)
+
+        failure.attempts += 1
+        failure.reason = reason
+        failure.last_failed = timezone.now()
+        failure.retry_after = failure.last_failed + min(base * 2 ** (failure.attempts - 1), maximum)
+        failure.save()
+
+        return failure
+
+
+class AnalysisJob(models.Model):
+    """A queued request to analyse a song, run by the <analysis_worker> management command.
+
+    Web requests only enqueue jobs and read the analyses they produce; the pipeline itself runs in worker processes
+    so throughput scales with the number of workers rather than tying up web workers.
+    """
+
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+    STATUS_CHOICES = [
+        (PENDING, "Pending"),
+        (RUNNING, "Running"),
+        (DONE, "Done"),
+        (FAILED, "Failed"),
+    ]
+
+    song = models.ForeignKey(Song, on_delete=models.CASCADE, related_name="analysis_jobs")
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    run_after = models.DateTimeField(default=timezone.now)  # Pushed back when the job is rate-limited
+    claimed_by = models.CharField(max_length=100, blank=True)
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["status", "run_after"])]
+        constraints = [
+            # At most one active job per song, so concurrent requests for the same song share it
+            models.UniqueConstraint(fields=["song"], condition=models.Q(status__in=["pending", "running"]),
+                                    name="unique_active_analysis_job"),
+        ]
+
+    def __str__(self):
+        return f"{self.song_id}: {self.status}"
+
+    @classmethod
+    def enqueue(cls, songs) -> int:
+        """Queue analysis for every song in <songs> that needs it; return how many are still being analysed.
+
+        Songs that are already analysed, backing off after a failure (see AnalysisFailure) or whose last job failed
+        within ANALYSIS_JOB_FAILURE_COOLDOWN aren't queued.
+        """
+        isrcs = {song.isrc for song in songs}
+        isrcs -= set(SongFeatures.objects.filter(song__in=isrcs).values_list("song_id", flat=True))
+
+        if not isrcs:
+            return 0
+
+        current_time = timezone.now()
+        cooldown = getattr(settings, "ANALYSIS_JOB_FAILURE_COOLDOWN", DEFAULT_ANALYSIS_JOB_FAILURE_COOLDOWN)
+
+        isrcs -= set(
+            AnalysisFailure.objects.filter(song__in=isrcs, retry_after__gt=current_time)
+            .values_list("song_id", flat=True)
+        )
+        isrcs -= set(
+            cls.objects.filter(song__in=isrcs, status=cls.FAILED, finished_at__gt=current_time - cooldown)
+            .values_list("song_id", flat=True)
+        )
+
+        # Songs that already have an active job hit the partial unique constraint and are skipped
+        cls.objects.bulk_create([cls(song_id=isrc) for isrc in isrcs], ignore_conflicts=True)
+
+        return cls.objects.filter(song__in=isrcs, status__in=[cls.PENDING, cls.RUNNING]).count()
+
+    @classmethod
+    def claim(cls, worker_name: str, limit: int) -> list["AnalysisJob"]:
+        """Atomically claim up to <limit> runnable jobs for <worker_name>"""
+        current_time = timezone.now()
+        runnable = cls.objects.filter(status=cls.PENDING, run_after__lte=current_time).order_by("id")
+        claim = {"status": cls.RUNNING, "claimed_at": current_time, "attempts": models.F("attempts") + 1}
+
+        if connection.features.has_select_for_update_skip_locked:
+            with transaction.atomic():
+                ids = list(runnable.select_for_update(skip_locked=True).values_list("id", flat=True)[:limit])
+                cls.objects.filter(id__in=ids).update(claimed_by=worker_name, **claim)
+        else:
+            # e.g. SQLite: no row locks, but each UPDATE is atomic. Tag the rows we win with a unique token so a
+            # concurrent worker racing for the same rows can't be mistaken for us.
+            token = f"{worker_name}:{uuid.uuid4().hex}"
+            ids = list(runnable.values_list("id", flat=True)[:limit])
+            cls.objects.filter(id__in=ids, status=cls.PENDING).update(claimed_by=token, **claim)
+            ids = list(cls.objects.filter(claimed_by=token).values_list("id", flat=True))
+            cls.objects.filter(id__in=ids).update(claimed_by=worker_name)
+
+        return list(cls.objects.filter(id__in=ids).select_related("song", "song__features"))
+
+    @classmethod
+    def release_stale(cls) -> int:
+        """Return jobs whose worker died mid-analysis to the queue"""
+        timeout = getattr(settings, "ANALYSIS_JOB_TIMEOUT", DEFAULT_ANALYSIS_JOB_TIMEOUT)
+
+        return cls.objects.filter(status=cls.RUNNING, claimed_at__lt=timezone.now() - timeout).update(
+            status=cls.PENDING, claimed_by="", claimed_at=None
+        )
+
+    @classmethod
+    def release(cls, jobs: list["AnalysisJob"], worker_name: str, delay: timedelta) -> None:
+        """Return <jobs> that <worker_name> still holds to the queue, to be retried after <delay>.
+
+        For a batch that broke off unexpectedly. Jobs that have already been claimed ANALYSIS_JOB_MAX_ATTEMPTS times
+        fail instead, so a song that always breaks the worker isn't retried forever.
+        """
+        current_time = timezone.now()
+        max_attempts = getattr(settings, "ANALYSIS_JOB_MAX_ATTEMPTS", DEFAULT_ANALYSIS_JOB_MAX_ATTEMPTS)
+        held = cls.objects.filter(id__in=[job.id for job in jobs], status=cls.RUNNING, claimed_by=worker_name)
+
+        with transaction.atomic():
+            held.filter(attempts__gte=max_attempts).update(status=cls.FAILED, finished_at=current_time)
+            held.update(status=cls.PENDING, run_after=current_time + delay, claimed_by="", claimed_at=None)
+
+
+class AnalysisRateLimited(Exception):
+    def __init__(self, retry_seconds: int | None) -> None:
+        super().__init__(f"Rate limited; retry after {retry_seconds}s")
+        self.retry_seconds = retry_seconds
+
+
+class AnalysisRejected(Exception):
+    pass
+
+
+class AnalysisUnavailable(Exception):
+    """Raised when a provider failed for a transient reason (e.g. a 5xx); not recorded as an AnalysisFailure"""
+
+
+class PreviewError(ValueError):
+    """Raised when a song's preview can't be obtained; <reason> is one of the AnalysisFailure reasons"""
+
+    def __init__(self, message: str, reason: str) -> None:
+        super().__init__(message)
+        self.reason = reason
 
 
 class UserPlaylist(models.Model):
@@ -215,6 +713,7 @@ class UserPlaylist(models.Model):
     playlist_name = models.CharField(max_length=200)
     songs = models.ManyToManyField(Song, through="PlaylistSong")
     image_url = models.URLField(blank=True)
+    snapshot_id = models.CharField(max_length=200, blank=True)  # Spotify's version of the playlist at the last sync
 
     def __str__(self):
         return self.playlist_name
@@ -223,37 +722,124 @@ class UserPlaylist(models.Model):
         return run_analysis(self.songs.all())
 
 
-def run_analysis(song_collection, remove_failures: bool = False):
-    feature_vectors = []
-    songs_to_remove = []
+def run_analysis(song_collection, remove_failures: bool = False, background: bool | None = None) -> np.ndarray:
+    """Analyse every song in <song_collection> concurrently and return their feature vectors in collection order.
 
-    for song in song_collection:
-        print(f"Analysing: {song.song_title}")
-        print(f"::::{song}::::")
-        result = song.set_song_analysis()
+    The result is a (songs x features) float32 array. Songs with stored features are loaded in a single query; only
+    the rest go through the analysis pipeline.
 
-        if result and result[0] == 200:
-            feature_vectors.append(song.analysis.to_list())
-        else:
-            if remove_failures:
-                print(f"Error for {song.song_title}; Skipping and removing song.")
-                songs_to_remove.append(song)
+    If <remove_failures> is set, songs that couldn't be analysed are removed from <song_collection> (which must then
+    be a list) so it stays aligned with the returned feature vectors.
+
+    In <background> mode (settings.ANALYSIS_IN_BACKGROUND by default) nothing is analysed inline: songs without an
+    analysis are queued as AnalysisJobs and treated as failures until a worker has analysed them.
+    """
+    songs = list(song_collection)
+
+    if background is None:
+        background = getattr(settings, "ANALYSIS_IN_BACKGROUND", False)
+
+    found, vectors = load_feature_vectors(song.isrc for song in songs)
+    stored = dict(zip(found, vectors))
+    missing = [song for song in songs if song.isrc not in stored]
+
+    if background:
+        AnalysisJob.enqueue(missing)
+        analysed = {}
+    else:
+        # Songs that failed recently are due another attempt only once their backoff has passed; treat them as
+        # failures
+        blocked = set(
+            AnalysisFailure.objects.filter(song__in=[song.isrc for song in missing], retry_after__gt=timezone.now())
+            .values_list("song_id", flat=True)
+        )
+        to_analyse = [song for song in missing if song.isrc not in blocked]
+
+        analysed = {}
+
+        for song, result in zip(to_analyse, analyse_songs(to_analyse)):
+            vector = analysed_vector(result)
+
+            # e.g. (429, retry_seconds) once the song ran out of rate-limit retries
+            if vector is not None:
+                analysed[song.isrc] = vector
+
+    rows = []
+    songs_to_remove = []
+
+    for song in songs:
+        if song.isrc in stored:
+            rows.append(stored[song.isrc])
+        elif song.isrc in analysed:
+            rows.append(np.asarray(analysed[song.isrc], dtype=FEATURE_DTYPE))
+        elif remove_failures:
+            print(f"Error for {song.song_title}; Skipping and removing song.")
+            songs_to_remove.append(song)
 
     for song in songs_to_remove:
         song_collection.remove(song)
 
-    return feature_vectors
+    if not rows:
+        return np.empty((0, len(features.FEATURE_NAMES)), dtype=FEATURE_DTYPE)
+
+    return np.vstack(rows)
+
+
+def get_top_tracks_refresher() -> ThreadPoolExecutor:
+    """Return the process-wide executor that refreshes stale <ArtistTopTracks> in the background.
+
+    Bounded by ARTIST_TOP_TRACKS_REFRESH_WORKERS, so a request over many stale artists queues their refreshes rather
+    than starting a thread for each.
+    """
+    global _top_tracks_refresher
+
+    with _top_tracks_refresher_lock:
+        if _top_tracks_refresher is None:
+            num_workers = getattr(settings, "ARTIST_TOP_TRACKS_REFRESH_WORKERS",
+                                  DEFAULT_ARTIST_TOP_TRACKS_REFRESH_WORKERS)
+            _top_tracks_refresher = ThreadPoolExecutor(max_workers=num_workers,
+                                                       thread_name_prefix="top-tracks-refresh")
+
+        return _top_tracks_refresher
+
 
+def deezer_preview_ttl(preview_url: str) -> int:
+    """Return how long (in seconds) <preview_url> can be cached.
 
-def parseint(s: str) -> int | None:
-    match = re.search(r"retry after (\d+)", s)
+    Deezer preview URLs are signed and stop working at the "exp=<unix time>" in their hdnea token, so the TTL is
+    capped to expire a safety margin before that.
+    """
+    ttl = getattr(settings, "DEEZER_PREVIEW_TTL", DEFAULT_DEEZER_PREVIEW_TTL)
+    match = re.search(r"exp=(\d+)", preview_url)
 
     if match:
-        retry_seconds = int(match.group(1))
-        return retry_seconds  # Output: 4
-    else:
-        print("No retry time found.")
-        return None
+        ttl = min(ttl, int(match.group(1)) - int(time.time()) - DEEZER_EXPIRY_MARGIN)
+
+    return ttl
+
+
+def iter_response_content(response, chunk_size: int = STREAM_CHUNK_SIZE) -> Iterator[bytes]:
+    """Yield the body of a streamed <response>, closing the connection once it's consumed (or abandoned)"""
+    with response:
+        yield from response.iter_content(chunk_size=chunk_size)
+
+
+def iter_multipart_file(field_name: str, filename: str, content_type: str, chunks: Iterable[bytes],
+                        boundary: str) -> Iterator[bytes]:
+    """Yield a multipart/form-data body holding a single file field whose content is <chunks>.
+
+    Passing this as <data> to requests sends it with chunked transfer encoding, so the file never has to be
+    buffered to compute a Content-Length.
+    """
+    yield (
+        f"--{boundary}\r\n"
+        f'Content-Disposition: form-data; name="{field_name}"; filename="{filename}"\r\n'
+        f"Content-Type: {content_type}\r\n\r\n"
+    ).encode()
+
+    yield from chunks
+
+    yield f"\r\n--{boundary}--\r\n".encode()
 
 
 #
@@ -313,3 +899,91 @@ class PlaylistSong(models.Model):
 
     def __str__(self):
         return f"{self.song.song_title}: {self.playlist.playlist_name}"
+
+
+class SyncJob(models.Model):
+    """A background sync of a user's Spotify playlists (see recommender.sync), polled by the client for its progress.
+
+    Each playlist's songs are committed, along with its snapshot ID, as soon as they've been fetched. Progress is
+    therefore visible while the job runs, and a sync that dies part-way is resumed by the next one, which skips the
+    playlists already saved.
+
+    Instance Attributes:
+        - owned_only, selected_ids: The sync request's filters; <selected_ids> is None to sync every playlist
+        - playlists: The IDs of the user's UserPlaylists in Spotify's order, once they've been listed
+        - playlists_total: How many playlists have changed and so have tracks to fetch
+        - playlists_synced, tracks_synced: Progress so far
+        - updated_at: Bumped as the job progresses; active jobs not updated within SYNC_JOB_TIMEOUT are assumed dead
+    """
+
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+    STATUS_CHOICES = [
+        (PENDING, "Pending"),
+        (RUNNING, "Running"),
+        (DONE, "Done"),
+        (FAILED, "Failed"),
+    ]
+    ACTIVE = [PENDING, RUNNING]
+
+    spotify_user = models.ForeignKey(UserSpotifyProfile, on_delete=models.CASCADE, related_name="sync_jobs")
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    owned_only = models.BooleanField(default=False)
+    selected_ids = models.JSONField(null=True, blank=True)
+    playlists = models.JSONField(default=list, blank=True)
+    playlists_total = models.PositiveIntegerField(default=0)
+    playlists_synced = models.PositiveIntegerField(default=0)
+    tracks_synced = models.PositiveIntegerField(default=0)
+    reauth_required = models.BooleanField(default=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(default=timezone.now)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            # At most one active sync per user, so repeated requests share it instead of racing each other
+            models.UniqueConstraint(fields=["spotify_user"], condition=models.Q(status__in=["pending", "running"]),
+                                    name="unique_active_sync_job"),
+        ]
+
+    def __str__(self):
+        return f"{self.spotify_user}: {self.status}"
+
+    @classmethod
+    def release_stale(cls) -> int:
+        """Fail active jobs whose process died mid-sync, so their users can start another"""
+        timeout = getattr(settings, "SYNC_JOB_TIMEOUT", DEFAULT_SYNC_JOB_TIMEOUT)
+        current_time = timezone.now()
+
+        return cls.objects.filter(status__in=cls.ACTIVE, updated_at__lt=current_time - timeout).update(
+            status=cls.FAILED, finished_at=current_time
+        )
+
+    def is_stale(self) -> bool:
+        timeout = getattr(settings, "SYNC_JOB_TIMEOUT", DEFAULT_SYNC_JOB_TIMEOUT)
+
+        return self.status in self.ACTIVE and timezone.now() - self.updated_at > timeout
+
+    def has_filters(self, owned_only: bool, selected_ids: list[str] | None) -> bool:
+        """Return whether this job syncs the playlists a sync with these filters would (regardless of ID order)"""
+        if self.owned_only != owned_only or (self.selected_ids is None) != (selected_ids is None):
+            return False
+
+        return selected_ids is None or set(self.selected_ids) == set(selected_ids)
+
+    def record_playlist(self, num_tracks: int) -> None:
+        """Count a synced playlist of <num_tracks> tracks towards this job's progress"""
+        SyncJob.objects.filter(id=self.id).update(playlists_synced=models.F("playlists_synced") + 1,
+                                                   tracks_synced=models.F("tracks_synced") + num_tracks,
+                                                   updated_at=timezone.now())
+
+    def finish(self, status: str, reauth_required: bool = False) -> None:
+        self.status = status
+        self.reauth_required = reauth_required
+        self.finished_at = self.updated_at = timezone.now()
+
+        # Only the fields set here, so the progress counted by <record_playlist> isn't overwritten
+        self.save(update_fields=["status", "reauth_required", "finished_at", "updated_at"])
@@ -1,105 +1,174 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from django.conf import settings
+
+from .catalog_index import get_catalog_index
+from .ingest import ingest_songs
 from .models import *
-from sklearn.metrics.pairwise import cosine_similarity
+from .scoring import DEFAULT_TOP_K, MEAN, score_candidates, top_n
+from .threads import closing_connection
+
+DEFAULT_CATALOG_CANDIDATES = 500
+DEFAULT_CANDIDATE_FETCH_WORKERS = 8
 
 
-def recommend_songs(user_playlists, spotify_profile) -> dict:
-    compared_feature_vectors = []
+def recommend_songs(user_playlists, spotify_profile, n: int | None = None, scoring: str = MEAN,
+                    k: int = DEFAULT_TOP_K) -> dict:
+    """Score candidate songs by their cosine similarity to the songs of <user_playlists>.
 
-    for playlist in user_playlists:
-        playlist_feature_vectors = playlist.set_playlist_analysis()
-        compared_feature_vectors.extend(playlist_feature_vectors)
+    <scoring> is one of <scoring.SCORING_MODES>: the mean similarity to every user song, the similarity to the closest
+    one, or the mean similarity to the <k> closest. Returns the <n> best candidates (all of them if n is None) as a
+    mapping from song to score, best first.
+
+    Candidates come from each source in settings.CANDIDATE_SOURCES: "artists" (the top tracks of the artists in the
+    playlists, from Spotify) and "catalog" (the already-analysed songs closest to the playlists, from the
+    <CatalogIndex>).
+    """
+    compared_feature_vectors = np.vstack([playlist.set_playlist_analysis() for playlist in user_playlists])
 
     user_songs = [song for playlist in user_playlists for song in playlist.songs.all()]
 
-    candidate_song_info = get_candidate_songs(user_songs, spotify_profile)
+    candidate_sources = getattr(settings, "CANDIDATE_SOURCES", ["artists"])
+    candidate_songs = []
+
+    if "artists" in candidate_sources:
+        candidate_song_info = get_candidate_songs(user_songs, spotify_profile)
 
-    candidate_status = candidate_song_info.get("status_code")
+        candidate_status = candidate_song_info.get("status_code")
 
-    candidate_songs = candidate_song_info["tracks"]
+        if candidate_status == 401:
+            return {"reauth_required": True, "status_code": candidate_status}
+        elif candidate_status != 200:
+            return {"reauth_required": False, "status_code": candidate_status}
 
-    if candidate_status == 401:
-        return {"reauth_required": True, "status_code": candidate_status}
-    elif candidate_status != 200:
-        return {"reauth_required": False, "status_code": candidate_status}
+        candidate_songs = candidate_song_info["tracks"]
+
+    if "catalog" in candidate_sources:
+        candidate_songs += get_catalog_candidates(compared_feature_vectors, exclude=user_songs + candidate_songs)
+
+    # In background mode the songs are analysed by <analysis_worker> processes; hold off until they're done
+    if getattr(settings, "ANALYSIS_IN_BACKGROUND", False):
+        pending = AnalysisJob.enqueue(user_songs + candidate_songs)
+
+        if pending:
+            return {"pending": pending, "reauth_required": False, "status_code": 202}
 
     candidate_feature_vectors = run_analysis(candidate_songs, remove_failures=True)
 
-    similarity_scores = cosine_similarity(
-        candidate_feature_vectors, compared_feature_vectors
-    )
+    similarity_scores = score_candidates(candidate_feature_vectors, compared_feature_vectors, scoring, k)
 
-    similarity_mapping = {}
+    sorted_songs = {candidate_songs[i]: float(similarity_scores[i]) for i in top_n(similarity_scores, n)}
 
-    for i in range(len(candidate_songs)):
-        song = candidate_songs[i]
-        song_score = similarity_scores[i].mean()
-        similarity_mapping[song] = song_score
+    return {"sorted_songs": sorted_songs, "reauth_required": False, "status_code": 200}
 
-    return {"sorted_songs": sorted_dictionary_by_values(similarity_mapping), "reauth_required": False,
-            "status_code": 200}
 
+def get_catalog_candidates(user_feature_vectors, exclude, n: int | None = None) -> list:
+    """Return up to <n> (settings.CATALOG_CANDIDATES by default) analysed songs closest to <user_feature_vectors>.
 
-def get_candidate_songs(comparison_songs, spotify_profile):
-    user_artists = []
+    Songs in <exclude> are never returned. Nothing is fetched from Spotify and every returned song already has
+    stored features.
+    """
+    catalog_index = get_catalog_index()
 
-    for song in comparison_songs:
-        artist = song.artist
-        if artist not in user_artists:
-            user_artists.append(artist)
+    if catalog_index is None:
+        return []
 
-    spotify_profile.artists_discovered += len(user_artists)
+    if n is None:
+        n = getattr(settings, "CATALOG_CANDIDATES", DEFAULT_CATALOG_CANDIDATES)
 
-    artist_top_songs = []
-    for artist in user_artists:
-        top_tracks = artist.get_top_n_songs(spotify_profile=spotify_profile)
+    isrcs = catalog_index.search(user_feature_vectors, n, exclude={song.isrc for song in exclude})
+    songs = Song.objects.select_related("artist").in_bulk(isrcs)
 
-        tracks_status = top_tracks.get("status_code")
+    # Songs deleted since they were analysed may linger in the index
+    return [songs[isrc] for isrc in isrcs if isrc in songs]
 
-        if tracks_status == 401:
-            return {"reauth_required": True, "status_code": top_tracks.get("status_code")}
-        elif tracks_status != 200:
-            return {"reauth_required": False, "status_code": top_tracks.get("status_code")}
 
-        for track in top_tracks["tracks"]:
-            print(f"Adding {track['title']} by {track['artist']} to candidate songs")
-            song, song_created = Song.objects.get_or_create(isrc=track["isrc"])
+def get_artists_top_tracks(artists: list, spotify_profile) -> dict:
+    """Run <Artist.get_top_n_songs> for every artist in <artists> concurrently.
 
-            if song in artist_top_songs:
-                continue
+    On success, "top_tracks" holds each artist's result in the same order as <artists>. Otherwise the failure (e.g. a
+    401 because the user must re-authenticate) of the first artist in <artists> that failed is returned, whichever
+    finished first. Once an artist has failed, the artists after it are skipped, so they don't spend rate limiter
+    tokens on results that would be discarded.
+    """
+    if not artists:
+        return {"top_tracks": [], "reauth_required": False, "status_code": 200}
 
-            print(track)
+    num_workers = min(len(artists), getattr(settings, "CANDIDATE_FETCH_WORKERS", DEFAULT_CANDIDATE_FETCH_WORKERS))
+    executor = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="top-tracks")
 
-            if (song_created or not song.song_title or not song.artist or not song.album or not song.duration
-                    or not song.image_url or not song.spotify_uri):
+    first_failure = len(artists)  # Index of the first artist known to have failed
+    first_failure_lock = threading.Lock()
 
-                if not song.song_title:
-                    song.song_title = track["title"]
+    @closing_connection
+    def get_top_n_songs(i, artist) -> dict | None:
+        nonlocal first_failure
 
-                if not song.artist:
-                    song.artist = artist
+        if i > first_failure:
+            return None  # Never looked at; the failure of an earlier artist is returned instead
 
-                if not song.album:
-                    song.album = track["album"]
+        failed = True
 
-                if not song.duration:
-                    song.duration = track["duration"]
+        try:
+            top_tracks = artist.get_top_n_songs(spotify_profile=spotify_profile)
+            failed = top_tracks.get("status_code") != 200
+            return top_tracks
+        finally:
+            if failed:
+                with first_failure_lock:
+                    first_failure = min(first_failure, i)
 
-                if not song.image_url:
-                    song.image_url = track["image_url"]
+    try:
+        futures = [executor.submit(get_top_n_songs, i, artist) for i, artist in enumerate(artists)]
 
-                if not song.spotify_uri:
-                    song.spotify_uri = track["spotify_uri"]
+        # In artist order, so which failure is returned doesn't depend on timing; every artist before the first
+        # failure runs, and none after it is waited for
+        for future in futures:
+            top_tracks = future.result()
 
-                song.save()
+            if top_tracks.get("status_code") != 200:
+                return top_tracks
 
-            artist_top_songs.append(song)
+        return {"top_tracks": [future.result() for future in futures], "reauth_required": False, "status_code": 200}
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
 
-    return {"tracks": artist_top_songs, "reauth_required": False, "status_code": 200}
 
+def get_candidate_songs(comparison_songs, spotify_profile):
+    # Distinct artists, in the order they first appear (loaded in one query rather than one per song)
+    artist_ids = list(dict.fromkeys(song.artist_id for song in comparison_songs if song.artist_id))
+    artists = Artist.objects.in_bulk(artist_ids)
+    user_artists = [artists[artist_id] for artist_id in artist_ids if artist_id in artists]
+
+    spotify_profile.artists_discovered += len(user_artists)
+
+    artists_top_tracks = get_artists_top_tracks(user_artists, spotify_profile)
+    tracks_status = artists_top_tracks.get("status_code")
+
+    if tracks_status == 401:
+        return {"reauth_required": True, "status_code": tracks_status}
+    elif tracks_status != 200:
+        return {"reauth_required": False, "status_code": tracks_status}
+
+    tracks = [
+        {
+            "isrc": track["isrc"],
+            "song_title": track["title"],
+            "artist_spotify_id": artist.spotify_id,
+            "artist_name": artist.artist_name,
+            "album": track["album"],
+            "duration": track["duration"],
+            "image_url": track["image_url"],
+            "spotify_uri": track["spotify_uri"],
+        }
+        for artist, top_tracks in zip(user_artists, artists_top_tracks["top_tracks"])
+        for track in top_tracks["tracks"]
+    ]
+
+    # Dicts keep insertion order, so candidates stay in artist order without duplicates
+    artist_top_songs = list(ingest_songs(tracks).values())
+
+    return {"tracks": artist_top_songs, "reauth_required": False, "status_code": 200}
 
-def sorted_dictionary_by_values(d: dict) -> dict:
-    """Return a sorted dictionary in non-increasing order, maintaining the original mapping"""
-    return {
-        key: value
-        for key, value in sorted(d.items(), key=lambda kv: kv[1], reverse=True)
-    }
@@ -0,0 +1,213 @@
+import hashlib
+import os
+import re
+import tempfile
+import threading
+from pathlib import Path
+from typing import Iterable, Iterator
+
+from django.conf import settings
+
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+READ_CHUNK_SIZE = 64 * 1024
+
+_preview_cache = None
+_preview_cache_lock = threading.Lock()
+
+
+class PreviewCache:
+    """A content-addressed on-disk cache of transcoded previews.
+
+    Layout:
+        - objects/<sha256>.mp3: The transcoded audio, named by the hash of its content
+        - refs/<isrc>: The hash of the audio belonging to that ISRC
+
+    Identical audio shared by several ISRCs is stored once. Every write goes to a temporary file first and is moved
+    into place with os.replace, so readers (including other processes) never see a partial file. Reading an object
+    bumps its modification time, and once the objects outgrow <max_bytes> the least recently used are evicted.
+    """
+
+    def __init__(self, directory: Path, max_bytes: int) -> None:
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.objects_dir = self.directory / "objects"
+        self.refs_dir = self.directory / "refs"
+
+        self.objects_dir.mkdir(parents=True, exist_ok=True)
+        self.refs_dir.mkdir(parents=True, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._size_estimate = None
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+
+    def get(self, isrc: str) -> Path | None:
+        """Return the path of the cached preview for <isrc>, or None on a miss"""
+        path = self._object_path_for(isrc)
+
+        if path is not None:
+            try:
+                os.utime(path)  # Mark as recently used
+            except FileNotFoundError:
+                path = None  # Evicted (possibly by another process) since the ref was read
+
+        with self._lock:
+            if path is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+
+        return path
+
+    def read(self, isrc: str) -> bytes | None:
+        path = self.get(isrc)
+
+        if path is None:
+            return None
+
+        try:
+            return path.read_bytes()
+        except FileNotFoundError:
+            return None
+
+    def iter_chunks(self, isrc: str) -> Iterator[bytes] | None:
+        """Return an iterator over the cached preview for <isrc> in chunks, or None on a miss"""
+        path = self.get(isrc)
+
+        if path is None:
+            return None
+
+        try:
+            f = path.open("rb")
+        except FileNotFoundError:
+            return None
+
+        return _iter_file(f)
+
+    def put(self, isrc: str, data: bytes) -> None:
+        digest = hashlib.sha256(data).hexdigest()
+        object_path = self.objects_dir / f"{digest}.mp3"
+
+        if object_path.exists():
+            os.utime(object_path)
+        else:
+            self._atomic_write(object_path, [data])
+
+        self._commit(isrc, digest, len(data))
+
+    def tee(self, isrc: str, chunks: Iterable[bytes]) -> Iterator[bytes]:
+        """Yield <chunks> unchanged while writing them to the cache under <isrc>.
+
+        The entry is only committed once <chunks> is fully consumed without error, so an interrupted stream never
+        leaves a truncated preview behind.
+        """
+        hasher = hashlib.sha256()
+        size = 0
+
+        with tempfile.NamedTemporaryFile(dir=self.objects_dir, suffix=".tmp", delete=False) as f:
+            temp_path = Path(f.name)
+
+            try:
+                for chunk in chunks:
+                    f.write(chunk)
+                    hasher.update(chunk)
+                    size += len(chunk)
+                    yield chunk
+            except BaseException:
+                f.close()
+                temp_path.unlink(missing_ok=True)
+                raise
+
+        digest = hasher.hexdigest()
+        os.replace(temp_path, self.objects_dir / f"{digest}.mp3")
+        self._commit(isrc, digest, size)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "writes": self.writes, "evictions": self.evictions}
+
+    def evict(self) -> None:
+        """Delete least recently used objects until the cache fits in <max_bytes>"""
+        entries = []
+
+        for path in self.objects_dir.glob("*.mp3"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        evicted = 0
+
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+
+            path.unlink(missing_ok=True)
+            total -= size
+            evicted += 1
+
+        # Refs pointing at evicted objects are left in place; <get> treats them as misses and they're overwritten
+        # the next time the song is transcoded.
+        with self._lock:
+            self._size_estimate = total
+            self.evictions += evicted
+
+    def _commit(self, isrc: str, digest: str, size: int) -> None:
+        self._atomic_write(self._ref_path(isrc), [digest.encode()])
+
+        with self._lock:
+            self.writes += 1
+
+            # The first write in a process doesn't know the cache's size yet; the eviction pass below measures it
+            if self._size_estimate is not None:
+                self._size_estimate += size
+
+            needs_eviction = self._size_estimate is None or self._size_estimate > self.max_bytes
+
+        if needs_eviction:
+            self.evict()
+
+    def _object_path_for(self, isrc: str) -> Path | None:
+        try:
+            digest = self._ref_path(isrc).read_text().strip()
+        except FileNotFoundError:
+            return None
+
+        return self.objects_dir / f"{digest}.mp3"
+
+    def _ref_path(self, isrc: str) -> Path:
+        return self.refs_dir / re.sub(r"[^A-Za-z0-9_-]", "_", isrc)
+
+    def _atomic_write(self, path: Path, chunks: Iterable[bytes]) -> None:
+        with tempfile.NamedTemporaryFile(dir=path.parent, suffix=".tmp", delete=False) as f:
+            for chunk in chunks:
+                f.write(chunk)
+
+        os.replace(f.name, path)
+
+
+def _iter_file(f) -> Iterator[bytes]:
+    with f:
+        while chunk := f.read(READ_CHUNK_SIZE):
+            yield chunk
+
+
+def get_preview_cache() -> PreviewCache | None:
+    """Return the process-wide <PreviewCache>, or None if PREVIEW_CACHE_DIR is unset"""
+    global _preview_cache
+
+    directory = getattr(settings, "PREVIEW_CACHE_DIR", None)
+
+    if not directory:
+        return None
+
+    with _preview_cache_lock:
+        if _preview_cache is None:
+            _preview_cache = PreviewCache(directory, getattr(settings, "PREVIEW_CACHE_MAX_BYTES", DEFAULT_MAX_BYTES))
+
+        return _preview_cache
@@ -0,0 +1,184 @@
+import re
+import time
+import uuid
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+
+import requests
+from django.conf import settings
+from django.core.cache import cache
+
+from . import http_client
+
+LOCK_TIMEOUT = 5  # seconds; a crashed holder can't block a host for longer than this
+LOCK_POLL_INTERVAL = 0.01
+MAX_WAIT_INTERVAL = 1.0  # Re-check shared state at least this often while waiting
+DEFAULT_MAX_RETRIES = 3
+
+
+class RateLimiter:
+    """A token bucket for one host, shared by every process through the Django cache.
+
+    The bucket holds up to <burst> tokens and refills at <rate> tokens per second; each request takes one. When the
+    host answers 429, <block> empties the bucket until the Retry-After time passes, so every worker in the deployment
+    backs off together instead of each discovering the limit on its own.
+    """
+
+    def __init__(self, host: str, rate: float, burst: int) -> None:
+        self.host = host
+        self.rate = rate
+        self.burst = burst
+        self.state_key = f"ratelimit:{host}:state"
+        self.lock_key = f"ratelimit:{host}:lock"
+
+    def acquire(self) -> float:
+        """Block until a request to this host is allowed; return how long that took in seconds"""
+        start_time = time.monotonic()
+
+        while True:
+            with self._locked():
+                state = self._load()
+
+                if state["blocked_until"] > state["updated"]:
+                    wait = state["blocked_until"] - state["updated"]
+                elif state["tokens"] >= 1:
+                    state["tokens"] -= 1
+                    self._save(state)
+                    return time.monotonic() - start_time
+                else:
+                    wait = (1 - state["tokens"]) / self.rate
+
+                self._save(state)
+
+            time.sleep(min(wait, MAX_WAIT_INTERVAL))
+
+    def block(self, seconds: float) -> None:
+        """Stop all requests to this host for <seconds>"""
+        with self._locked():
+            state = self._load()
+            state["tokens"] = 0
+            state["blocked_until"] = max(state["blocked_until"], state["updated"] + seconds)
+            self._save(state)
+
+    def _load(self) -> dict:
+        now = time.time()
+        state = cache.get(self.state_key) or {"tokens": self.burst, "updated": now, "blocked_until": 0}
+
+        if now >= state["blocked_until"]:
+            elapsed = max(0.0, now - max(state["updated"], state["blocked_until"]))
+            state["tokens"] = min(self.burst, state["tokens"] + elapsed * self.rate)
+
+        state["updated"] = now
+        return state
+
+    def _save(self, state: dict) -> None:
+        cache.set(self.state_key, state, timeout=None)
+
+    def _locked(self):
+        return CacheLock(self.lock_key)
+
+
+class CacheLock:
+    """A cross-process mutex built on the atomic <cache.add>.
+
+    The lock expires after <timeout> seconds, so a holder that died can't block the others for longer than that, and
+    entering it waits at most as long. The block runs either way; <acquired> says whether it holds the lock.
+    """
+
+    def __init__(self, key: str, timeout: int = LOCK_TIMEOUT) -> None:
+        self.key = key
+        self.timeout = timeout
+        self.token = uuid.uuid4().hex
+        self.acquired = False
+
+    def __enter__(self):
+        deadline = time.monotonic() + self.timeout
+
+        while not cache.add(self.key, self.token, timeout=self.timeout):
+            if time.monotonic() > deadline:
+                return self  # The holder most likely died; the lock is about to expire anyway
+
+            time.sleep(LOCK_POLL_INTERVAL)
+
+        self.acquired = True
+        return self
+
+    def __exit__(self, *exc_info):
+        if cache.get(self.key) == self.token:
+            cache.delete(self.key)
+
+
+def get_rate_limiter(url: str) -> RateLimiter | None:
+    """Return the limiter for <url>'s host, or None if settings.RATE_LIMITS doesn't limit it"""
+    host = urlparse(url).netloc
+    limits = getattr(settings, "RATE_LIMITS", {}).get(host)
+
+    if limits is None:
+        return None
+
+    return RateLimiter(host, limits["rate"], limits["burst"])
+
+
+def throttle(url: str) -> None:
+    limiter = get_rate_limiter(url)
+
+    if limiter:
+        limiter.acquire()
+
+
+def block_host(url: str, seconds: float) -> None:
+    limiter = get_rate_limiter(url)
+
+    if limiter:
+        limiter.block(seconds)
+
+
+def limited_request(method: str, url: str, max_retries: int = DEFAULT_MAX_RETRIES, **kwargs) -> requests.Response:
+    """Send a request through <url>'s host limiter and <http_client>, retrying up to <max_retries> times on 429.
+
+    A 429 blocks the host for every worker for as long as the response's Retry-After (or "retry after N" body)
+    says; the retry then waits on the limiter like any other request. Pass max_retries=0 for requests whose body
+    can't be sent twice (e.g. a streamed upload).
+    """
+    for attempt in range(max_retries + 1):
+        throttle(url)
+        response = http_client.request(method, url, **kwargs)
+
+        if response.status_code != 429:
+            break
+
+        retry_seconds = retry_after_seconds(response) or 1
+        print(f"Rate limited by {urlparse(url).netloc}; backing off for {retry_seconds}s")
+        block_host(url, retry_seconds)
+
+        if attempt < max_retries:
+            response.close()  # Return the connection to the pool
+
+    return response
+
+
+def retry_after_seconds(response: requests.Response) -> float | None:
+    """Return how long <response> asks us to wait before retrying, from its Retry-After header or its body"""
+    header = response.headers.get("Retry-After")
+
+    if header:
+        if header.strip().isdigit():
+            return int(header)
+
+        try:
+            return max(0.0, parsedate_to_datetime(header).timestamp() - time.time())
+        except (TypeError, ValueError):
+            pass
+
+    return parseint(response.text)
+
+
+def parseint(s: str) -> int | None:
+    match = re.search(r"retry after (\d+)", s)
+
+    if match:
+        retry_seconds = int(match.group(1))
+        return retry_seconds  # Output: 4
+    else:
+        print("No retry time found.")
+        return None
@@ -0,0 +1,112 @@
+import numpy as np
+from django.conf import settings
+
+from .features import FEATURE_DTYPE
+
+# Ways of aggregating a candidate's similarities to the user's songs into one score
+MEAN = "mean"  # Mean similarity to all of them
+MAX = "max"  # Similarity to the closest one
+TOP_K = "topk"  # Mean similarity to the <k> closest ones
+SCORING_MODES = [MEAN, MAX, TOP_K]
+
+DEFAULT_TOP_K = 10
+DEFAULT_MEMORY_LIMIT = 64 * 1024 * 1024  # bytes
+USER_BLOCK_SIZE = 4096
+
+
+def normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    """Return a float32 copy of <vectors> with every row scaled to unit L2 norm (all-zero rows stay zero)"""
+    vectors = np.asarray(vectors, dtype=FEATURE_DTYPE)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+def mean_similarity(candidate_vectors: np.ndarray, user_vectors: np.ndarray) -> np.ndarray:
+    """Return the mean cosine similarity of each candidate to every user vector.
+
+    Identical to cosine_similarity(candidate_vectors, user_vectors).mean(axis=1), but since the mean of dot products
+    is the dot product with the mean, the (candidates x users) matrix is never built: the normalized user vectors are
+    averaged into a centroid once and every candidate is scored with a single matrix-vector product.
+    """
+    if len(user_vectors) == 0:
+        return np.zeros(len(candidate_vectors), dtype=FEATURE_DTYPE)
+
+    centroid = normalize_rows(user_vectors).mean(axis=0)
+
+    return normalize_rows(candidate_vectors) @ centroid
+
+
+def score_candidates(candidate_vectors: np.ndarray, user_vectors: np.ndarray, mode: str = MEAN,
+                     k: int = DEFAULT_TOP_K) -> np.ndarray:
+    """Return each candidate's score against <user_vectors> under scoring <mode> (one of SCORING_MODES)"""
+    if mode == MEAN:
+        return mean_similarity(candidate_vectors, user_vectors)
+    elif mode == MAX:
+        return top_k_similarity(candidate_vectors, user_vectors, 1)
+    elif mode == TOP_K:
+        return top_k_similarity(candidate_vectors, user_vectors, k)
+
+    raise ValueError(f"Unknown scoring mode {mode!r}; expected one of {SCORING_MODES}")
+
+
+def top_k_similarity(candidate_vectors: np.ndarray, user_vectors: np.ndarray, k: int,
+                     memory_limit: int | None = None) -> np.ndarray:
+    """Return, for each candidate, the mean of its <k> highest cosine similarities to the user vectors.
+
+    k=1 gives each candidate's similarity to its closest user song. Unlike the mean, this can't be reduced to a
+    centroid, so similarities are computed in (candidate block x user block) tiles sized to fit in <memory_limit>
+    bytes (settings.SIMILARITY_MEMORY_LIMIT by default). Each candidate keeps a running top <k> across the user
+    blocks, so the full (candidates x users) matrix never exists and memory stays flat however large either side is.
+    """
+    num_candidates = len(candidate_vectors)
+    k = min(k, len(user_vectors))
+
+    if num_candidates == 0 or k <= 0:
+        return np.zeros(num_candidates, dtype=FEATURE_DTYPE)
+
+    if memory_limit is None:
+        memory_limit = getattr(settings, "SIMILARITY_MEMORY_LIMIT", DEFAULT_MEMORY_LIMIT)
+
+    candidates = normalize_rows(candidate_vectors)
+    users = normalize_rows(user_vectors)
+
+    user_block_size = min(len(users), USER_BLOCK_SIZE)
+    # Each candidate row of a tile holds one block of similarities plus its running top k
+    row_bytes = FEATURE_DTYPE.itemsize * (user_block_size + k)
+    candidate_block_size = max(1, min(num_candidates, memory_limit // row_bytes))
+
+    scores = np.empty(num_candidates, dtype=FEATURE_DTYPE)
+
+    for start in range(0, num_candidates, candidate_block_size):
+        block = candidates[start:start + candidate_block_size]
+        best = np.full((len(block), k), -np.inf, dtype=FEATURE_DTYPE)
+
+        for user_start in range(0, len(users), user_block_size):
+            similarities = block @ users[user_start:user_start + user_block_size].T
+
+            if k == 1:
+                np.maximum(best[:, 0], similarities.max(axis=1), out=best[:, 0])
+            else:
+                merged = np.concatenate([best, similarities], axis=1)
+                best = np.partition(merged, merged.shape[1] - k, axis=1)[:, -k:]
+
+        scores[start:start + len(block)] = best.mean(axis=1)
+
+    return scores
+
+
+def top_n(scores: np.ndarray, n: int | None = None) -> np.ndarray:
+    """Return the indices of the <n> highest <scores> (all of them if n is None), highest first.
+
+    Only the top <n> are sorted; argpartition finds them in linear time.
+    """
+    if n is None or n >= len(scores):
+        return np.argsort(-scores, kind="stable")
+
+    if n <= 0:
+        return np.empty(0, dtype=np.intp)
+
+    top = np.argpartition(-scores, n - 1)[:n]
+
+    return top[np.argsort(-scores[top], kind="stable")]
@@ -1,5 +1,5 @@
 from rest_framework import serializers
-from .models import Song, Artist, PlaylistSong, UserPlaylist
+from .models import Song, Artist, PlaylistSong, SyncJob, UserPlaylist
 
 
 class ArtistSerializer(serializers.ModelSerializer):
@@ -38,3 +38,9 @@ class RecommendedPlaylistSerializer(serializers.ModelSerializer):
     class Meta:
         model = UserPlaylist
         fields = ("id", "playlist_name", "playlist_songs", "image_url")
+
+
+class SyncJobSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = SyncJob
+        fields = ("id", "status", "playlists_total", "playlists_synced", "tracks_synced", "reauth_required")
@@ -0,0 +1,140 @@
+import threading
+from itertools import groupby
+from operator import itemgetter
+
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from utils.spotify_api import SpotifySyncError, get_user_spotify_playlists, iter_spotify_songs_from_playlists
+from .ingest import ingest_playlist_pages, ingest_playlists, reconcile_playlist_songs
+from .models import SyncJob
+from .threads import closing_connection
+
+
+class SyncConflict(Exception):
+    """Raised when a sync is requested while the user has one running with different filters.
+
+    Instance Attributes:
+        - job: The running <SyncJob>
+    """
+
+    def __init__(self, job: SyncJob) -> None:
+        super().__init__(f"Sync job {job.id} is already running with different filters")
+        self.job = job
+
+
+def start_sync(spotify_profile, owned_only: bool = False, selected_ids: list[str] | None = None) -> SyncJob:
+    """Start syncing <spotify_profile>'s playlists in a background thread and return its <SyncJob>.
+
+    If the user already has a sync running with the same filters, that job is returned instead of starting another;
+    if its filters differ, SyncConflict is raised rather than dropping the new ones.
+    """
+    SyncJob.release_stale()
+
+    active_job = SyncJob.objects.filter(spotify_user=spotify_profile, status__in=SyncJob.ACTIVE).first()
+
+    if active_job is None:
+        try:
+            with transaction.atomic():
+                job = SyncJob.objects.create(spotify_user=spotify_profile, owned_only=owned_only,
+                                             selected_ids=selected_ids)
+        except IntegrityError:
+            # Another request started one in between
+            active_job = SyncJob.objects.get(spotify_user=spotify_profile, status__in=SyncJob.ACTIVE)
+
+    if active_job is not None:
+        if not active_job.has_filters(owned_only, selected_ids):
+            raise SyncConflict(active_job)
+
+        return active_job
+
+    # Once the job is committed, so the thread is guaranteed to find it
+    transaction.on_commit(
+        lambda: threading.Thread(target=run_sync_job, args=(job.id,), name=f"sync-{job.id}", daemon=True).start()
+    )
+
+    return job
+
+
+@closing_connection
+def run_sync_job(job_id: int) -> None:
+    job = SyncJob.objects.select_related("spotify_user").get(id=job_id)
+
+    try:
+        sync_playlists(job)
+        job.finish(SyncJob.DONE)
+    except SpotifySyncError as e:
+        print(e)
+        job.finish(SyncJob.FAILED, reauth_required=True)
+    except Exception as e:
+        # Nobody else would see it; record the failure so the client stops polling
+        print(f"Sync job {job_id} failed: {e!r}")
+        job.finish(SyncJob.FAILED)
+
+
+def sync_playlists(job: SyncJob) -> None:
+    """Sync the playlists of <job>'s user, committing (and recording the progress of) one playlist at a time.
+
+    Raises SpotifySyncError if the playlists or their tracks can't be fetched.
+    """
+    spotify_profile = job.spotify_user
+    spotify_playlists = get_user_spotify_playlists(spotify_profile, owned_only=job.owned_only)
+
+    if spotify_playlists is None:
+        raise SpotifySyncError("Couldn't list the user's Spotify playlists")
+
+    user_playlists = ingest_playlists(spotify_profile, spotify_playlists)
+
+    # Delete the playlists that are NOT on Spotify anymore
+    spotify_profile.user_playlists.exclude(id__in=[playlist.id for playlist in user_playlists]).delete()
+
+    # (tracklist_href, tracklist_length, playlist_instance) of the playlists whose tracks changed since the last sync
+    tracklists = []
+
+    for playlist, playlist_instance in zip(spotify_playlists, user_playlists):
+        if job.selected_ids is not None and playlist["id"] not in job.selected_ids:
+            continue
+
+        # Spotify changes a playlist's snapshot ID whenever its tracks change, so an unchanged snapshot means the
+        # stored songs are already up to date (including those saved by an earlier, interrupted sync)
+        if playlist_instance.snapshot_id and playlist_instance.snapshot_id == playlist.get("snapshot_id"):
+            continue
+
+        tracklists.append((playlist["tracks"]["href"], playlist["tracks"]["total"], playlist_instance))
+
+        # Only saved along with the playlist's songs
+        playlist_instance.snapshot_id = playlist.get("snapshot_id", "")
+
+    job.status = SyncJob.RUNNING
+    job.playlists = [playlist.id for playlist in user_playlists]
+    job.playlists_total = len(tracklists)
+    job.updated_at = timezone.now()
+    job.save(update_fields=["status", "playlists", "playlists_total", "updated_at"])
+
+    # Pages arrive in playlist order, so each playlist is saved as soon as its last page has been ingested
+    pages = iter_spotify_songs_from_playlists(tracklists, spotify_profile)
+    next_playlist = 0
+
+    for i, playlist_pages in groupby(pages, key=itemgetter(0)):
+        # Playlists without any tracks have no pages; they're emptied as they're passed
+        for tracklist in tracklists[next_playlist:i]:
+            save_playlist(job, tracklist[2], [])
+
+        save_playlist(job, tracklists[i][2], ingest_playlist_pages(page for _, page in playlist_pages))
+        next_playlist = i + 1
+
+    for tracklist in tracklists[next_playlist:]:
+        save_playlist(job, tracklist[2], [])
+
+    spotify_profile.last_synced = timezone.now()
+    spotify_profile.save(update_fields=["last_synced"])
+
+
+def save_playlist(job: SyncJob, playlist_instance, playlist_songs: list) -> None:
+    """Commit the songs and snapshot ID of <playlist_instance>, then count it towards <job>'s progress"""
+    with transaction.atomic():
+        # Only write the PlaylistSong rows that differ from what's stored, rather than rewriting them all
+        reconcile_playlist_songs([playlist_instance], playlist_songs)
+        playlist_instance.save(update_fields=["snapshot_id"])
+
+    job.record_playlist(len(playlist_songs))
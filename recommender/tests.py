@@ -1,3 +1,293 @@
-from django.test import TestCase
+import os
+import threading
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from django.test import TestCase, TransactionTestCase
+from django.utils import timezone
+from sklearn.metrics.pairwise import cosine_similarity
+
+from accounts.models import CustomUser, UserSpotifyProfile
+from utils import spotify_tokens
+from .features import FEATURE_NAMES
+from .ingest import reconcile_playlist_songs
+from .models import AnalysisJob, PlaylistSong, Song, UserPlaylist
+from .scoring import mean_similarity, top_k_similarity
+
+
+def run_in_threads(target, num_threads: int) -> None:
+    """Run <target> on <num_threads> threads at once, wait for them all and re-raise the first exception, if any"""
+    barrier = threading.Barrier(num_threads)
+    errors = []
+
+    def run():
+        try:
+            barrier.wait()
+            target()
+        except Exception as e:
+            errors.append(e)
+        finally:
+            connection.close()
+
+    threads = [threading.Thread(target=run) for _ in range(num_threads)]
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0]
+
+
+class AnalysisJobClaimTests(TransactionTestCase):
+    """<AnalysisJob.claim> without row locks (SQLite), where claims are told apart by a per-call token"""
+
+    def setUp(self):
+        songs = [Song.objects.create(song_title=f"Song {i}", isrc=f"ISRC{i:04}") for i in range(60)]
+        AnalysisJob.enqueue(songs)
+
+    def test_database_has_no_row_locks(self):
+        # Otherwise these tests would cover the select_for_update path instead
+        self.assertFalse(connection.features.has_select_for_update_skip_locked)
+
+    def test_claims_in_turn_never_overlap(self):
+        first = AnalysisJob.claim("worker-1", 25)
+        second = AnalysisJob.claim("worker-2", 25)
+
+        self.assertEqual(len(first), 25)
+        self.assertEqual(len(second), 25)
+        self.assertFalse({job.id for job in first} & {job.id for job in second})
+        self.assertTrue(all(job.claimed_by == "worker-1" for job in first))
+
+    def test_concurrent_claims_never_claim_a_job_twice(self):
+        claimed = []
+        claimed_lock = threading.Lock()
+
+        def claim_all():
+            while jobs := AnalysisJob.claim(threading.current_thread().name, 5):
+                with claimed_lock:
+                    claimed.extend(job.id for job in jobs)
+
+        run_in_threads(claim_all, 4)
+
+        self.assertEqual(len(claimed), len(set(claimed)))
+        self.assertEqual(set(claimed), set(AnalysisJob.objects.values_list("id", flat=True)))
+        self.assertFalse(AnalysisJob.objects.exclude(status=AnalysisJob.RUNNING).exists())
+        self.assertFalse(AnalysisJob.objects.exclude(attempts=1).exists())
+
+
+class SongFeaturesMigrationTests(TransactionTestCase):
+    """Migration 0015, which moves SongAnalysis rows into packed SongFeatures vectors (and back)"""
+
+    before = [("recommender", "0014_analysisjob")]
+    after = [("recommender", "0015_songfeatures")]
+
+    def tearDown(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(executor.loader.graph.leaf_nodes())
+
+    def migrate(self, targets):
+        executor = MigrationExecutor(connection)
+        executor.migrate(targets)
+
+        return executor.loader.project_state(targets).apps
+
+    def test_forwards_and_backwards(self):
+        apps = self.migrate(self.before)
+        Song = apps.get_model("recommender", "Song")
+        SongAnalysis = apps.get_model("recommender", "SongAnalysis")
+
+        values = {name: i / 10 for i, name in enumerate(FEATURE_NAMES)}
+        Song.objects.create(song_title="Analysed", isrc="ANALYSED",
+                            analysis=SongAnalysis.objects.create(source="local", **values))
+        Song.objects.create(song_title="Not analysed", isrc="PLAIN")
+
+        apps = self.migrate(self.after)
+        SongFeatures = apps.get_model("recommender", "SongFeatures")
+
+        song_features = SongFeatures.objects.get()
+        self.assertEqual(song_features.song_id, "ANALYSED")
+        self.assertEqual(song_features.extractor_version, "local-1")
+        np.testing.assert_allclose(np.frombuffer(bytes(song_features.vector), dtype="<f4"),
+                                   [values[name] for name in FEATURE_NAMES], rtol=1e-6)
+
+        apps = self.migrate(self.before)
+        Song = apps.get_model("recommender", "Song")
+
+        analysis = Song.objects.get(isrc="ANALYSED").analysis
+        self.assertEqual(analysis.source, "local")
+        for name in FEATURE_NAMES:
+            self.assertAlmostEqual(getattr(analysis, name), values[name], places=6)
+        self.assertIsNone(Song.objects.get(isrc="PLAIN").analysis)
+
+
+class ReconcilePlaylistSongsTests(TestCase):
+    def setUp(self):
+        user = CustomUser.objects.create_user(username="listener", email="listener@example.com", password="pw")
+        spotify_profile = UserSpotifyProfile.objects.create(user=user, spotify_id="listener")
+        self.playlist = UserPlaylist.objects.create(spotify_user=spotify_profile, playlist_name="Mix")
+        self.songs = [Song.objects.create(song_title=f"Song {i}", isrc=f"ISRC{i}") for i in range(5)]
+
+    def reconcile(self, indices: list[int]) -> dict[str, int]:
+        playlist_songs = [PlaylistSong(playlist=self.playlist, song=self.songs[i], order=order)
+                          for order, i in enumerate(indices)]
+
+        return reconcile_playlist_songs([self.playlist], playlist_songs)
+
+    def stored(self) -> list[tuple[str, int]]:
+        return list(self.playlist.playlist_songs.order_by("order").values_list("song_id", "order"))
+
+    def test_creates_new_songs(self):
+        self.assertEqual(self.reconcile([0, 1, 2]), {"created": 3, "updated": 0, "deleted": 0})
+        self.assertEqual(self.stored(), [("ISRC0", 0), ("ISRC1", 1), ("ISRC2", 2)])
+
+    def test_unchanged_playlist_writes_nothing(self):
+        self.reconcile([0, 1, 2])
+
+        self.assertEqual(self.reconcile([0, 1, 2]), {"created": 0, "updated": 0, "deleted": 0})
+
+    def test_removes_songs_no_longer_in_the_playlist(self):
+        self.reconcile([0, 1, 2, 3])
+
+        self.assertEqual(self.reconcile([0, 2]), {"created": 0, "updated": 1, "deleted": 2})
+        self.assertEqual(self.stored(), [("ISRC0", 0), ("ISRC2", 1)])
+
+    def test_reorders_in_place(self):
+        self.reconcile([0, 1, 2])
+        ids = dict(self.playlist.playlist_songs.values_list("song_id", "id"))
+
+        self.assertEqual(self.reconcile([2, 0, 1]), {"created": 0, "updated": 3, "deleted": 0})
+        self.assertEqual(self.stored(), [("ISRC2", 0), ("ISRC0", 1), ("ISRC1", 2)])
+        self.assertEqual(dict(self.playlist.playlist_songs.values_list("song_id", "id")), ids)
+
+    def test_duplicate_tracks_keep_their_first_position(self):
+        self.assertEqual(self.reconcile([0, 1, 0, 2]), {"created": 3, "updated": 0, "deleted": 0})
+        self.assertEqual(self.stored(), [("ISRC0", 0), ("ISRC1", 1), ("ISRC2", 3)])
+
+    def test_leaves_other_playlists_alone(self):
+        other = UserPlaylist.objects.create(spotify_user=self.playlist.spotify_user, playlist_name="Other")
+        PlaylistSong.objects.create(playlist=other, song=self.songs[4], order=0)
+
+        self.reconcile([0])
+
+        self.assertEqual(list(other.playlist_songs.values_list("song_id", flat=True)), ["ISRC4"])
+
+
+class ScoringTests(TestCase):
+    """The scores must match the full (candidates x users) sklearn similarity matrix they avoid building"""
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.candidates = rng.normal(size=(300, len(FEATURE_NAMES)))
+        self.users = rng.normal(size=(70, len(FEATURE_NAMES)))
+        self.similarities = cosine_similarity(self.candidates, self.users)
+
+    def expected_top_k(self, k: int) -> np.ndarray:
+        return np.sort(self.similarities, axis=1)[:, -k:].mean(axis=1)
+
+    def test_mean_similarity(self):
+        np.testing.assert_allclose(mean_similarity(self.candidates, self.users), self.similarities.mean(axis=1),
+                                   atol=1e-5)
+
+    def test_top_k_similarity(self):
+        for k in [1, 5, 70]:
+            with self.subTest(k=k):
+                np.testing.assert_allclose(top_k_similarity(self.candidates, self.users, k),
+                                           self.expected_top_k(k), atol=1e-5)
+
+    def test_top_k_similarity_in_small_tiles(self):
+        # Room for only a few candidate rows at a time, so the candidates are scored over many blocks
+        scores = top_k_similarity(self.candidates, self.users, 5, memory_limit=1024)
+
+        np.testing.assert_allclose(scores, self.expected_top_k(5), atol=1e-5)
+
+    def test_top_k_larger_than_the_user_songs(self):
+        np.testing.assert_allclose(top_k_similarity(self.candidates, self.users, 500), self.expected_top_k(70),
+                                   atol=1e-5)
+
+    def test_zero_vectors_score_zero(self):
+        candidates = np.vstack([np.zeros(len(FEATURE_NAMES)), self.candidates[:3]])
+
+        self.assertEqual(mean_similarity(candidates, self.users)[0], 0)
+        self.assertEqual(top_k_similarity(candidates, self.users, 3)[0], 0)
+
+    def test_no_user_songs(self):
+        self.assertFalse(mean_similarity(self.candidates, self.users[:0]).any())
+        self.assertFalse(top_k_similarity(self.candidates, self.users[:0], 5).any())
+
+
+@mock.patch.dict(os.environ, {"SPOTIFY_CLIENT_ID": "client-id"})
+class GetAccessTokenTests(TransactionTestCase):
+    """Concurrent <get_access_token> calls for one profile share a single refresh"""
+
+    def setUp(self):
+        spotify_tokens._tokens.clear()
+
+        user = CustomUser.objects.create_user(username="listener", email="listener@example.com", password="pw")
+        self.spotify_profile = UserSpotifyProfile.objects.create(
+            user=user, spotify_id="listener", access_token="old-token", refresh_token="refresh-token",
+            access_token_expiry=timezone.now() - timedelta(minutes=1),
+        )
+
+        self.refreshes = 0
+        self.refreshes_lock = threading.Lock()
+        patcher = mock.patch.object(spotify_tokens, "limited_request", side_effect=self.refresh)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def refresh(self, *args, **kwargs):
+        with self.refreshes_lock:
+            self.refreshes += 1
+            access_token = f"new-token-{self.refreshes}"
+
+        # Long enough for every other thread to pile up behind this refresh
+        threading.Event().wait(0.2)
+
+        return mock.Mock(status_code=200, json=lambda: {"access_token": access_token, "expires_in": 3600})
+
+    def get_tokens(self, num_threads: int, force: bool = False) -> list[str | None]:
+        tokens = []
+        # Loaded up front, so every thread starts from the token as it was before any refresh
+        profiles = [UserSpotifyProfile.objects.get(pk=self.spotify_profile.pk) for _ in range(num_threads)]
+
+        def get_token():
+            tokens.append(spotify_tokens.get_access_token(profiles.pop(), force=force))
+
+        run_in_threads(get_token, num_threads)
+        return tokens
+
+    def test_expired_token_is_refreshed_once(self):
+        tokens = self.get_tokens(8)
+
+        self.assertEqual(self.refreshes, 1)
+        self.assertEqual(tokens, ["new-token-1"] * 8)
+        self.assertEqual(UserSpotifyProfile.objects.get(pk=self.spotify_profile.pk).access_token, "new-token-1")
+
+    def test_valid_token_is_not_refreshed(self):
+        UserSpotifyProfile.objects.filter(pk=self.spotify_profile.pk).update(
+            access_token_expiry=timezone.now() + timedelta(hours=1)
+        )
+
+        self.assertEqual(self.get_tokens(4), ["old-token"] * 4)
+        self.assertEqual(self.refreshes, 0)
+
+    def test_forced_refreshes_are_coalesced(self):
+        UserSpotifyProfile.objects.filter(pk=self.spotify_profile.pk).update(
+            access_token_expiry=timezone.now() + timedelta(hours=1)
+        )
+
+        self.assertEqual(self.get_tokens(8, force=True), ["new-token-1"] * 8)
+        self.assertEqual(self.refreshes, 1)
+
+    def test_waiter_does_not_refresh_while_another_process_holds_the_lock(self):
+        lock = spotify_tokens.CacheLock(f"spotify-token:{self.spotify_profile.pk}:lock", timeout=30)
+
+        with mock.patch.object(spotify_tokens, "TOKEN_LOCK_TIMEOUT", 1), lock:
+            self.assertIsNone(spotify_tokens.get_access_token(self.spotify_profile))
+
+        self.assertEqual(self.refreshes, 0)
@@ -0,0 +1,21 @@
+from functools import wraps
+from typing import Callable
+
+from django.db import connection
+
+
+def closing_connection(func: Callable) -> Callable:
+    """Wrap <func> so that the calling thread's database connection is closed once it returns (or raises).
+
+    For work run on executor or background threads: they don't go through Django's request cycle, so nothing else
+    would release the connection they open (e.g. for the DB cache behind <limited_request>). Never use it for work run
+    on a request's own thread, whose connection may still be in a transaction.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            connection.close()
+
+    return wrapper
@@ -0,0 +1,245 @@
+import os
+import subprocess
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Iterable, Iterator
+
+import ffmpeg
+import imageio_ffmpeg
+import numpy as np
+from django.conf import settings
+
+# Deezer previews come in at a bit-rate ReccoBeats rejects; re-encode them with these settings
+OUTPUT_OPTIONS = {"format": "mp3", "audio_bitrate": "192k", "ac": 2, "ar": 44100}
+
+DEFAULT_TIMEOUT = 60  # seconds
+STREAM_CHUNK_SIZE = 64 * 1024
+FEEDER_JOIN_TIMEOUT = 1  # seconds a finished stream waits for its input thread before giving up its ffmpeg slot
+
+_transcoder = None
+_transcoder_lock = threading.Lock()
+
+
+class TranscodeError(RuntimeError):
+    pass
+
+
+class TranscodeResult:
+    """The output of a single transcode job.
+
+    Instance Attributes:
+        - data: The re-encoded audio
+        - queued_seconds: How long the job waited for a free ffmpeg slot
+        - transcode_seconds: How long ffmpeg itself ran
+    """
+
+    data: bytes
+    queued_seconds: float
+    transcode_seconds: float
+
+    def __init__(self, data: bytes, queued_seconds: float, transcode_seconds: float) -> None:
+        self.data = data
+        self.queued_seconds = queued_seconds
+        self.transcode_seconds = transcode_seconds
+
+
+class Transcoder:
+    """A bounded pool of ffmpeg processes.
+
+    At most <max_workers> ffmpeg processes run at once, whether buffered (<submit>) or streaming (<stream>); further
+    jobs wait for a free slot, and at most <max_pending> buffered jobs may be queued or running before <submit> blocks
+    the caller. Each job runs in its own ffmpeg process, so throughput scales with the number of cores rather than
+    being limited by the GIL.
+    """
+
+    def __init__(self, ffmpeg_exe: str, max_workers: int, max_pending: int, timeout: float = DEFAULT_TIMEOUT) -> None:
+        self.ffmpeg_exe = ffmpeg_exe
+        self.timeout = timeout
+        self.command = self.build_command()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ffmpeg")
+        self._slots = threading.BoundedSemaphore(max_workers)
+        self._pending = threading.BoundedSemaphore(max_pending)
+
+        self._stats_lock = threading.Lock()
+        self._jobs = 0
+        self._failures = 0
+        self._queued_seconds = 0.0
+        self._transcode_seconds = 0.0
+
+    def build_command(self) -> list[str]:
+        """Return the ffmpeg command line that re-encodes stdin to stdout"""
+        return (
+            ffmpeg.input("pipe:0")
+            .output("pipe:1", **OUTPUT_OPTIONS)
+            .global_args("-loglevel", "error")
+            .compile(cmd=self.ffmpeg_exe)
+        )
+
+    def build_pcm_command(self, sample_rate: int) -> list[str]:
+        """Return the ffmpeg command line that decodes stdin to mono float32 PCM at <sample_rate> on stdout"""
+        return (
+            ffmpeg.input("pipe:0")
+            .output("pipe:1", format="f32le", acodec="pcm_f32le", ac=1, ar=sample_rate)
+            .global_args("-loglevel", "error")
+            .compile(cmd=self.ffmpeg_exe)
+        )
+
+    def submit(self, data: bytes, command: list[str] | None = None) -> Future:
+        """Queue <data> for re-encoding and return a future resolving to a <TranscodeResult>.
+
+        <command> overrides the default re-encode (e.g. with <build_pcm_command>).
+        """
+        self._pending.acquire()
+
+        try:
+            future = self._executor.submit(self._run, data, command or self.command, time.perf_counter())
+        except BaseException:
+            self._pending.release()
+            raise
+
+        future.add_done_callback(lambda _: self._pending.release())
+        return future
+
+    def transcode(self, data: bytes) -> TranscodeResult:
+        """Re-encode <data>, blocking the calling thread until the job is done"""
+        return self.submit(data).result()
+
+    def decode_pcm(self, data: bytes, sample_rate: int) -> np.ndarray:
+        """Decode the audio in <data> to a mono float32 signal at <sample_rate>"""
+        result = self.submit(data, self.build_pcm_command(sample_rate)).result()
+        return np.frombuffer(result.data, dtype=np.float32)
+
+    def stream(self, chunks: Iterable[bytes]) -> Iterator[bytes]:
+        """Re-encode the audio in <chunks> as it arrives, yielding the output as ffmpeg produces it.
+
+        Input is fed to ffmpeg from a background thread, so a download feeding <chunks> overlaps with both the
+        encode and whatever consumes the output (e.g. an upload). Neither the input nor the output is ever held in
+        memory in full. Raises TranscodeError once the output is exhausted if ffmpeg failed, or if the whole stream
+        took longer than <timeout> (ffmpeg is then killed, so a stalled download or consumer can't hold a slot).
+        """
+        submitted_at = time.perf_counter()
+
+        with self._slots:
+            started_at = time.perf_counter()
+            process = subprocess.Popen(self.command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                       stderr=subprocess.PIPE)
+
+            timed_out = threading.Event()
+
+            def expire():
+                timed_out.set()
+                process.kill()  # Ends the read below, wherever the stream is stuck
+
+            feed_errors = []
+            stderr_chunks = []
+            feeder = threading.Thread(target=_feed_stdin, args=(process, chunks, feed_errors), daemon=True)
+            drainer = threading.Thread(target=lambda: stderr_chunks.append(process.stderr.read()), daemon=True)
+            watchdog = threading.Timer(self.timeout, expire)
+            watchdog.daemon = True
+            feeder.start()
+            drainer.start()
+            watchdog.start()
+
+            try:
+                while chunk := process.stdout.read(STREAM_CHUNK_SIZE):
+                    yield chunk
+
+                process.wait(timeout=max(0.0, started_at + self.timeout - time.perf_counter()))
+            except subprocess.TimeoutExpired:
+                timed_out.set()
+            finally:
+                watchdog.cancel()
+
+                # Reached early if the consumer stops iterating (e.g. the upload failed); don't leave ffmpeg behind
+                if process.poll() is None:
+                    process.kill()
+                    process.wait()
+
+                # The feeder may be blocked on the download feeding <chunks>; it stops at its next write to the dead
+                # process, so don't keep the slot waiting for it
+                feeder.join(timeout=FEEDER_JOIN_TIMEOUT)
+                drainer.join(timeout=FEEDER_JOIN_TIMEOUT)
+                process.stdout.close()
+
+            failed = process.returncode != 0 or bool(feed_errors)
+            self._record(started_at - submitted_at, time.perf_counter() - started_at, failed=failed)
+
+            if failed and timed_out.is_set():
+                raise TranscodeError(f"ffmpeg timed out after {self.timeout}s")
+            elif feed_errors:
+                raise feed_errors[0]
+            elif failed:
+                raise TranscodeError("ffmpeg failed:\n" + b"".join(stderr_chunks).decode(errors="replace"))
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            jobs = self._jobs
+
+            return {
+                "jobs": jobs,
+                "failures": self._failures,
+                "avg_queued_seconds": self._queued_seconds / jobs if jobs else 0.0,
+                "avg_transcode_seconds": self._transcode_seconds / jobs if jobs else 0.0,
+            }
+
+    def _run(self, data: bytes, command: list[str], submitted_at: float) -> TranscodeResult:
+        with self._slots:
+            started_at = time.perf_counter()
+
+            try:
+                process = subprocess.run(command, input=data, capture_output=True, timeout=self.timeout)
+            except subprocess.TimeoutExpired:
+                self._record(started_at - submitted_at, time.perf_counter() - started_at, failed=True)
+                raise TranscodeError(f"ffmpeg timed out after {self.timeout}s")
+
+        finished_at = time.perf_counter()
+        failed = process.returncode != 0
+        self._record(started_at - submitted_at, finished_at - started_at, failed=failed)
+
+        if failed:
+            raise TranscodeError("ffmpeg failed:\n" + process.stderr.decode(errors="replace"))
+
+        return TranscodeResult(process.stdout, started_at - submitted_at, finished_at - started_at)
+
+    def _record(self, queued_seconds: float, transcode_seconds: float, failed: bool) -> None:
+        with self._stats_lock:
+            self._jobs += 1
+            self._failures += failed
+            self._queued_seconds += queued_seconds
+            self._transcode_seconds += transcode_seconds
+
+
+def _feed_stdin(process: subprocess.Popen, chunks: Iterable[bytes], errors: list) -> None:
+    try:
+        for chunk in chunks:
+            process.stdin.write(chunk)
+    except BrokenPipeError:
+        pass  # ffmpeg exited early; its return code and stderr explain why
+    except Exception as e:
+        # e.g. the download feeding <chunks> broke off; surfaced by <Transcoder.stream> once ffmpeg finishes
+        errors.append(e)
+    finally:
+        try:
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+
+
+def get_transcoder() -> Transcoder:
+    """Return the process-wide <Transcoder>, resolving the bundled ffmpeg binary on first use"""
+    global _transcoder
+
+    with _transcoder_lock:
+        if _transcoder is None:
+            max_workers = getattr(settings, "TRANSCODE_WORKERS", None) or os.cpu_count() or 1
+            max_pending = getattr(settings, "TRANSCODE_MAX_PENDING", None) or max_workers * 4
+
+            _transcoder = Transcoder(
+                ffmpeg_exe=imageio_ffmpeg.get_ffmpeg_exe(),
+                max_workers=max_workers,
+                max_pending=max_pending,
+                timeout=getattr(settings, "TRANSCODE_TIMEOUT", DEFAULT_TIMEOUT),
+            )
+
+        return _transcoder
@@ -3,6 +3,7 @@ from . import views
 
 urlpatterns = [
     path('playlists', views.RetrieveUserSpotifyPlaylistsAPIView.as_view(), name="user-playlists"),
+    path('sync/<int:job_id>', views.SyncJobStatusAPIView.as_view(), name="sync-status"),
     path('find-music', views.ReccomendSongsAPIView.as_view(), name="find-music"),
     path('create-playlist', views.CreateSpotifyPlaylistAPIView.as_view(), name="create-playlist")
 ]
@@ -1,6 +1,4 @@
-import django.db.utils
-from django.db import transaction
-from django.utils.timezone import now
+from django.conf import settings
 from rest_framework import status
 from rest_framework.generics import GenericAPIView
 from rest_framework.permissions import IsAuthenticated
@@ -9,9 +7,13 @@ from rest_framework.response import Response
 from utils.spotify_api import *
 from .models import *
 from .music_recommender import recommend_songs
-from .serializers import SongSerializer, UserPlaylistSerializer
+from .scoring import DEFAULT_TOP_K, MEAN, SCORING_MODES
+from .serializers import SongSerializer, SyncJobSerializer, UserPlaylistSerializer
+from .sync import SyncConflict, start_sync
 from accounts.serializers import UserSpotifyProfileSerializer
 
+MAX_RECOMMENDED_SONGS = 200
+
 
 class RetrieveUserSpotifyPlaylistsAPIView(GenericAPIView):
     permission_classes = (IsAuthenticated,)
@@ -23,101 +25,57 @@ class RetrieveUserSpotifyPlaylistsAPIView(GenericAPIView):
             return Response(status=status.HTTP_400_BAD_REQUEST, data={"reauth_required": True})
 
         spotify_profile = user.spotify_profile
-        spotify_playlists_response = get_user_spotify_playlists(spotify_profile)
-
-        if spotify_playlists_response is None:
-            return Response(status=status.HTTP_500_INTERNAL_SERVER_ERROR, data={"reauth_required": True})
-
-        # Backend-used data for creating objects
-        playlist_songs = []
-        spotify_song_data = []
-
-        # Frontend-used data for sending objects; sending the newly created objects causes issues with Database writes
-        playlists_to_send = []
-
-        for playlist in spotify_playlists_response:
-
-            if playlist["images"]:
-                image_url = playlist["images"][0]["url"]
-            else:
-                image_url = ""
-
-            playlist_instance, created = UserPlaylist.objects.get_or_create(spotify_user=spotify_profile,
-                                                                            playlist_name=playlist["name"],
-                                                                            image_url=image_url,
-                                                                            spotify_id=playlist["id"])
-
-            tracklist_href, tracklist_length = playlist["tracks"]["href"], playlist["tracks"]["total"]
-
-            song_data = get_spotify_songs_from_playlist(tracklist_href, tracklist_length,
-                                                        spotify_profile, playlist_instance)
-
-            if song_data is None:
-                return Response(status=status.HTTP_500_INTERNAL_SERVER_ERROR, data={"reauth_required": True})
-
-            spotify_song_data.extend(song_data)
-
-            playlists_to_send.append(playlist_instance)
-
-        for song_data in spotify_song_data:
-            artist, artist_created = Artist.objects.get_or_create(
-                artist_name=song_data["artist_name"],
-                spotify_id=song_data["artist_spotify_id"]
-            )
-            song, song_created = Song.objects.get_or_create(
-                isrc=song_data["isrc"]
-            )
 
-            if (song_created or not song.song_title or not song.artist or not song.album or not song.duration
-                    or not song.image_url or not song.spotify_uri):
+        # Optional filters, applied before any tracks are fetched: only playlists the user owns, and/or only the
+        # playlists with the given Spotify IDs (the others are listed but their tracks aren't synced)
+        owned_only = request.data.get("owned_only", getattr(settings, "SYNC_OWNED_PLAYLISTS_ONLY", False))
+        selected_ids = request.data.get("playlist_ids")
 
-                print(song_data)
+        if selected_ids is not None and (not isinstance(selected_ids, list)
+                                         or not all(isinstance(playlist_id, str) for playlist_id in selected_ids)):
+            return Response(status=status.HTTP_400_BAD_REQUEST,
+                            data={"error": "playlist_ids must be a list of Spotify playlist IDs"})
 
-                if not song.song_title:
-                    song.song_title = song_data["song_title"]
-
-                if not song.artist:
-                    song.artist = artist
-
-                if not song.album:
-                    song.album = song_data["album"]
-
-                if not song.duration:
-                    song.duration = song_data["duration"]
+        # The sync runs in the background; the client polls SyncJobStatusAPIView with the returned job ID
+        try:
+            job = start_sync(spotify_profile, owned_only=bool(owned_only), selected_ids=selected_ids)
+        except SyncConflict as e:
+            # Only one sync runs per user; the client can poll the running one, or retry once it has finished
+            return Response(status=status.HTTP_409_CONFLICT,
+                            data={"error": str(e), "job_id": e.job.id,
+                                  "retry_after": getattr(settings, "SYNC_POLL_INTERVAL", 1)})
 
-                if not song.image_url:
-                    song.image_url = song_data["image_url"]
+        return Response(status=status.HTTP_202_ACCEPTED,
+                        data={"job_id": job.id, "retry_after": getattr(settings, "SYNC_POLL_INTERVAL", 1)})
 
-                if not song.spotify_uri:
-                    song.spotify_uri = song_data["spotify_uri"]
 
-                song.save()
+class SyncJobStatusAPIView(GenericAPIView):
+    permission_classes = (IsAuthenticated,)
 
-            playlist_songs.append(PlaylistSong(
-                playlist=song_data["playlist_instance"],
-                song=song,
-                order=song_data["order"]
-            ))
+    def get(self, request, job_id, *args, **kwargs):
+        user = self.request.user
 
-        try:
-            with transaction.atomic():
-                # To avoid duplicates and remove deleted playlists and keep updated w/ current selection of playlists:
-                # This deletes the PlaylistSong objects related to the playlists we're updating to make way for new ones
-                PlaylistSong.objects.filter(playlist__in=playlists_to_send).delete()
+        if not user or not hasattr(user, 'spotify_profile'):
+            return Response(status=status.HTTP_400_BAD_REQUEST, data={"reauth_required": True})
 
-                # Delete the playlists that are NOT in playlists_to_send (i.e., deleted on Spotify)
-                # In other words, delete all playlists EXCEPT the playlists we've recieved
-                spotify_profile.user_playlists.exclude(id__in=[playlist.id for playlist in playlists_to_send]).delete()
+        job = SyncJob.objects.filter(id=job_id, spotify_user=user.spotify_profile).first()
 
-                transaction.on_commit(lambda: PlaylistSong.objects.bulk_create(playlist_songs))
+        if job is None:
+            return Response(status=status.HTTP_404_NOT_FOUND)
 
-        except django.db.utils.Error as e:
-            print(e)
+        # The process running the job died
+        if job.is_stale():
+            job.finish(SyncJob.FAILED)
 
-        spotify_profile.last_synced = now()
-        spotify_profile.save()
+        data = SyncJobSerializer(job).data
 
-        data = UserPlaylistSerializer(playlists_to_send, many=True).data
+        if job.status == SyncJob.DONE:
+            playlists = UserPlaylist.objects.in_bulk(job.playlists)
+            data["playlists"] = UserPlaylistSerializer(
+                [playlists[playlist_id] for playlist_id in job.playlists if playlist_id in playlists], many=True
+            ).data
+        elif job.status != SyncJob.FAILED:
+            data["retry_after"] = getattr(settings, "SYNC_POLL_INTERVAL", 1)
 
         return Response(status=status.HTTP_200_OK, data=data)
 
@@ -133,16 +91,30 @@ class ReccomendSongsAPIView(GenericAPIView):
         playlist_ids = [playlist["spotify_id"] for playlist in request.data]
         playlists = UserPlaylist.objects.filter(spotify_id__in=playlist_ids).all()
 
-        recommended_song_info = recommend_songs(playlists, request.user.spotify_profile)
+        # e.g. ?scoring=topk&k=5 to rank by the mean similarity to the 5 closest songs in the chosen playlists
+        scoring = request.query_params.get("scoring", MEAN)
+        k = request.query_params.get("k", str(DEFAULT_TOP_K))
+
+        if scoring not in SCORING_MODES or not k.isdigit() or int(k) < 1:
+            return Response(status=status.HTTP_400_BAD_REQUEST,
+                            data={"error": f"scoring must be one of {SCORING_MODES} and k a positive integer"})
+
+        recommended_song_info = recommend_songs(playlists, request.user.spotify_profile, n=MAX_RECOMMENDED_SONGS,
+                                                scoring=scoring, k=int(k))
 
         if recommended_song_info.get("status_code") == 401:
             return Response(status=401, data={"reauth_required": True})
+        elif recommended_song_info.get("status_code") == 202:
+            # Still analysing in the background; the client polls by re-sending the request
+            return Response(status=status.HTTP_202_ACCEPTED,
+                            data={"pending": recommended_song_info["pending"],
+                                  "retry_after": getattr(settings, "ANALYSIS_POLL_INTERVAL", 3)})
         elif recommended_song_info.get("status_code") != 200:
             return Response(status=recommended_song_info.get("status_code"))
 
         recommended_songs = recommended_song_info.get("sorted_songs")
 
-        serialized_recommended_songs = [SongSerializer(song).data for song in list(recommended_songs.keys())[:200]]
+        serialized_recommended_songs = [SongSerializer(song).data for song in recommended_songs]
 
         spotify_profile = request.user.spotify_profile
         spotify_profile.playlists_created += 1
@@ -1,19 +1,39 @@
 import os
 from base64 import b64encode
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from itertools import islice
 from pathlib import Path
-from typing import Optional
+from typing import Iterator, Optional
 from urllib.parse import urlencode
 import requests
 
+from django.conf import settings
 from django.utils.timezone import now
 from dotenv import load_dotenv
 
 from recommender.models import *
+from recommender.ratelimit import limited_request
+from recommender.threads import closing_connection
+from utils.spotify_tokens import get_access_token
 
 env_path = Path(__file__).resolve().parent.parent / "config" / ".env"
 load_dotenv(dotenv_path=env_path)
 
+PAGE_SIZE = 100  # Spotify's maximum for playlist items
+PLAYLIST_PAGE_SIZE = 50  # Spotify's maximum for a user's playlists
+DEFAULT_PAGE_WORKERS = 8
+PAGE_WINDOW_FACTOR = 2  # Pages fetched ahead of the consumer, per page worker
+
+# Only the parts of each playlist item that <get_tracks> reads; drops e.g. available markets and full album objects
+PLAYLIST_ITEM_FIELDS = ("items(track(name,uri,is_local,duration_ms,external_ids(isrc),album(name,images(url)),"
+                        "artists(id,name)))")
+
+
+class SpotifySyncError(Exception):
+    pass
+
 
 def get_encoded_client_credentials():
     client_id = os.environ.get("SPOTIFY_CLIENT_ID", "")
@@ -46,7 +66,7 @@ def get_spotify_tokens(code: str) -> tuple[Optional[str], Optional[datetime], Op
     }
 
     try:
-        response = requests.post(url=spotify_url, data=form, headers=headers)
+        response = limited_request("POST", url=spotify_url, data=form, headers=headers)
 
         # Instead of doing response.raise_for_status() I wrap in a try-except block to send None, None, None upstream
         # See <refresh_curr_tokens> for more details
@@ -69,20 +89,18 @@ def get_spotify_tokens(code: str) -> tuple[Optional[str], Optional[datetime], Op
 
 
 def get_spotify_details(spotify_profile) -> tuple[Optional[str], Optional[str], Optional[str]]:
-    # i.e. access token is expired
-    if now() > spotify_profile.access_token_expiry:
-        # access_token expired, refresh needed
-        is_refreshed = refresh_curr_tokens(spotify_profile)
+    access_token = get_access_token(spotify_profile)
 
-        if not is_refreshed:
-            return None, None, None
+    # i.e. the token couldn't be refreshed
+    if access_token is None:
+        return None, None, None
 
     headers = {
-        "Authorization": f"Bearer {spotify_profile.access_token}"
+        "Authorization": f"Bearer {access_token}"
     }
 
     try:
-        response = requests.get(url="https://api.spotify.com/v1/me", headers=headers)
+        response = limited_request("GET", url="https://api.spotify.com/v1/me", headers=headers)
         response.raise_for_status()
         data = response.json()
 
@@ -98,112 +116,130 @@ def get_spotify_details(spotify_profile) -> tuple[Optional[str], Optional[str],
         return None, None, None
 
 
-def refresh_curr_tokens(spotify_profile) -> bool:
-    """Refresh and save user spotify tokens. Return whether tokens were succesfully saved"""
-    refresh_url = "https://accounts.spotify.com/api/token"
-    refresh_token = spotify_profile.refresh_token
+def get_user_spotify_playlists(spotify_profile, owned_only: bool = False):
+    """Return every playlist in the user's library (only those they own if <owned_only>), or None on failure.
+
+    The first page tells us how many playlists there are; the rest are then fetched concurrently.
+    """
+    base_url = f"https://api.spotify.com/v1/users/{spotify_profile.spotify_id}/playlists?"
+
+    access_token = get_access_token(spotify_profile)
+
+    if access_token is None:
+        return None
 
     headers = {
-        'Content-Type': 'application/x-www-form-urlencoded'
+        "Authorization": f"Bearer {access_token}"
     }
 
-    client_id = os.environ.get("SPOTIFY_CLIENT_ID", None)
+    def get_page(offset):
+        url = base_url + urlencode({"limit": PLAYLIST_PAGE_SIZE, "offset": offset})
 
-    if client_id is None:
-        return False
+        try:
+            response = limited_request("GET", url=url, headers=headers)
+            response.raise_for_status()
+            return response.json()
+        except requests.exceptions.HTTPError as e:
+            print(e)
+            return None
 
-    body = urlencode({
-        "grant_type": "refresh_token",
-        "refresh_token": refresh_token,
-        "client_id": client_id
-    })
+    first_page = get_page(0)
 
-    response = requests.post(url=refresh_url, data=body, headers=headers)
+    if first_page is None:
+        return None
 
-    # i.e. Refresh token has expired; return None upstream until the View recieves it, then return an HTTP-Response
-    # that the frontend recieves --> this triggers redirect to OAuth.
-    if response.status_code == 401:
-        return False
+    offsets = range(PLAYLIST_PAGE_SIZE, first_page["total"], PLAYLIST_PAGE_SIZE)
+    num_workers = getattr(settings, "SPOTIFY_PAGE_WORKERS", DEFAULT_PAGE_WORKERS)
 
-    try:
-        data = response.json()
+    with ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="spotify-playlists") as executor:
+        pages = [first_page] + list(executor.map(closing_connection(get_page), offsets))
 
-        access_token = data["access_token"]
-        access_token_expiry = now() + timedelta(seconds=data["expires_in"])
+    if None in pages:
+        return None
 
-        # Per Spotify API, refresh token may be replaced or maintained after new access token is issued
-        refresh_token = data.get("refresh_token", refresh_token)
+    playlists = [playlist for page in pages for playlist in page["items"] if playlist]
 
-        spotify_profile.access_token = access_token
-        spotify_profile.refresh_token = refresh_token
-        spotify_profile.access_token_expiry = access_token_expiry
-        spotify_profile.save()
+    if owned_only:
+        playlists = [playlist for playlist in playlists if playlist["owner"]["id"] == spotify_profile.spotify_id]
 
-        return True
-    except KeyError as e:
-        print(e)
-        return False
+    return playlists
 
 
-def get_user_spotify_playlists(spotify_profile):
-    base_url = f"https://api.spotify.com/v1/users/{spotify_profile.spotify_id}/playlists?"
-    data = {
-        "limit": 10
-    }
+def get_spotify_songs_from_playlist(tracklist_href: str, tracklist_length: int, spotify_profile, playlist_instance):
+    songs = get_spotify_songs_from_playlists([(tracklist_href, tracklist_length, playlist_instance)], spotify_profile)
 
-    url = base_url + urlencode(data)
+    return None if songs is None else songs[0]
 
-    if now() > spotify_profile.access_token_expiry:
-        is_refreshed = refresh_curr_tokens(spotify_profile)
 
-        if not is_refreshed:
-            return None
+def get_spotify_songs_from_playlists(tracklists: list[tuple], spotify_profile) -> Optional[list[list[dict]]]:
+    """Fetch the songs of every (tracklist_href, tracklist_length, playlist_instance) in <tracklists>.
 
-    headers = {
-        "Authorization": f"Bearer {spotify_profile.access_token}"
-    }
+    Returns a list of songs per entry of <tracklists>, or None if any page fails. See
+    <iter_spotify_songs_from_playlists> for a version that doesn't hold every song in memory at once.
+    """
+    playlist_song_entries = [[] for _ in tracklists]
 
     try:
-        response = requests.get(url=url, headers=headers)
-        response.raise_for_status()
-        data = response.json()
-
-        print([playlist for playlist in data["items"] if playlist["owner"]["id"] == spotify_profile.spotify_id])
-
-        # return [playlist for playlist in data["items"] if playlist["owner"]["id"] == spotify_profile.spotify_id]
-        return data["items"]
-    except requests.exceptions.HTTPError as e:
+        for i, page in iter_spotify_songs_from_playlists(tracklists, spotify_profile):
+            playlist_song_entries[i].extend(page)
+    except SpotifySyncError as e:
         print(e)
         return None
 
+    return playlist_song_entries
 
-def get_spotify_songs_from_playlist(tracklist_href: str, tracklist_length: int, spotify_profile, playlist_instance):
-    fields = {
-        "limit": 100,
-        "offset": 0,
-    }
 
-    playlist_song_entries = []
+def iter_spotify_songs_from_playlists(tracklists: list[tuple], spotify_profile) -> Iterator[tuple[int, list[dict]]]:
+    """Yield the songs of every (tracklist_href, tracklist_length, playlist_instance) in <tracklists> page by page.
 
-    while fields["offset"] < tracklist_length:
-        # i.e. access token is expired
-        if now() > spotify_profile.access_token_expiry:
-            # access_token expired, refresh needed
-            is_refreshed = refresh_curr_tokens(spotify_profile)
+    Yields (index into <tracklists>, songs of the page) in playlist order, page by page. Pages are fetched
+    concurrently, at most SPOTIFY_PAGE_WORKERS at a time, but only a small window of them runs ahead of the consumer,
+    so memory doesn't grow with the size of the playlists. Raises SpotifySyncError if the token can't be refreshed or
+    a page fails.
+    """
+    if get_access_token(spotify_profile) is None:
+        raise SpotifySyncError("Couldn't refresh the Spotify access token")
 
-            if not is_refreshed:
-                return None
+    pages = (
+        (i, offset)
+        for i, (tracklist_href, tracklist_length, playlist_instance) in enumerate(tracklists)
+        for offset in range(0, tracklist_length, PAGE_SIZE)
+    )
 
-        new_entries = get_tracks(tracklist_href, fields, spotify_profile.access_token, playlist_instance)
+    num_workers = getattr(settings, "SPOTIFY_PAGE_WORKERS", DEFAULT_PAGE_WORKERS)
+    executor = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="spotify-pages")
 
-        if new_entries is None:
-            return None
+    def submit(i, offset):
+        tracklist_href, tracklist_length, playlist_instance = tracklists[i]
+        fields = {"limit": PAGE_SIZE, "offset": offset, "fields": PLAYLIST_ITEM_FIELDS}
 
-        playlist_song_entries.extend(new_entries)
+        # Per page, so a sync longer than the token's lifetime picks up the refreshed one (usually from the cache)
+        access_token = get_access_token(spotify_profile)
 
-        fields["offset"] += 100
+        if access_token is None:
+            raise SpotifySyncError("Couldn't refresh the Spotify access token")
 
-    return playlist_song_entries
+        return i, executor.submit(closing_connection(get_tracks), tracklist_href, fields, access_token, playlist_instance)
+
+    try:
+        # Pages are yielded in the order they were submitted; later ones keep downloading in the meantime
+        in_flight = deque(submit(i, offset) for i, offset in islice(pages, num_workers * PAGE_WINDOW_FACTOR))
+
+        while in_flight:
+            i, future = in_flight.popleft()
+            page = future.result()
+
+            if page is None:
+                raise SpotifySyncError(f"Failed to fetch tracks of {tracklists[i][2]}")
+
+            next_page = next(pages, None)
+
+            if next_page is not None:
+                in_flight.append(submit(*next_page))
+
+            yield i, page
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
 
 
 def get_tracks(tracklist_href, fields, access_token, playlist_instance):
@@ -214,7 +250,8 @@ def get_tracks(tracklist_href, fields, access_token, playlist_instance):
         "Authorization": f"Bearer {access_token}"
     }
     try:
-        response = requests.get(url=url, headers=headers)
+        response = limited_request("GET", url=url, headers=headers)
+        response.raise_for_status()
 
         data = response.json()
 
@@ -225,12 +262,13 @@ def get_tracks(tracklist_href, fields, access_token, playlist_instance):
 
             track = item["track"]
 
-            if track["is_local"]:
+            # <track> is null for items that are no longer available
+            if not track or track["is_local"]:
                 continue
 
             try:
                 image_url = track["album"]["images"][0]["url"]
-            except IndexError or KeyError:
+            except (IndexError, KeyError):
                 image_url = ""
 
             playlist_songs_data.append({
@@ -254,9 +292,16 @@ def get_tracks(tracklist_href, fields, access_token, playlist_instance):
 
 def create_spotify_playlist(spotify_profile):
     api_url = f"https://api.spotify.com/v1/users/{spotify_profile.spotify_id}/playlists"
+    access_token = get_access_token(spotify_profile)
+
+    if access_token is None:
+        return {
+            "status_code": 401,
+            "reauth_required": True
+        }
 
     headers = {
-        "Authorization": f"Bearer {spotify_profile.access_token}"
+        "Authorization": f"Bearer {access_token}"
     }
 
     body = {
@@ -265,7 +310,7 @@ def create_spotify_playlist(spotify_profile):
                        "@ https://github.com/andrewpols",
     }
 
-    response = requests.post(url=api_url, json=body, headers=headers)
+    response = limited_request("POST", url=api_url, json=body, headers=headers)
 
     if response.status_code == 401:
         return {
@@ -292,9 +337,13 @@ def add_songs_to_playlist(playlist_id: str, songs_to_add: list[str], spotify_pro
     try:
         api_url = f"https://api.spotify.com/v1/playlists/{playlist_id}/tracks"
         position = 0
+        access_token = get_access_token(spotify_profile)
+
+        if access_token is None:
+            return {"created": False, "reauth_required": True, "status_code": 401}
 
         headers = {
-            "Authorization": f"Bearer {spotify_profile.access_token}"
+            "Authorization": f"Bearer {access_token}"
         }
 
         while position < len(songs_to_add):
@@ -303,7 +352,7 @@ def add_songs_to_playlist(playlist_id: str, songs_to_add: list[str], spotify_pro
                 "position": position
             }
 
-            response = requests.post(url=api_url, json=body, headers=headers)
+            response = limited_request("POST", url=api_url, json=body, headers=headers)
 
             if response.status_code == 401:
                 return {"created": False, "reauth_required": True, "status_code": response.status_code}
@@ -0,0 +1,167 @@
+import os
+import threading
+from contextlib import contextmanager
+from datetime import timedelta
+from pathlib import Path
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils.timezone import now
+from dotenv import load_dotenv
+
+from accounts.models import UserSpotifyProfile
+from recommender.ratelimit import CacheLock, limited_request
+
+env_path = Path(__file__).resolve().parent.parent / "config" / ".env"
+load_dotenv(dotenv_path=env_path)
+
+# Tokens are refreshed this long before they expire, so a request (or a long sync) never starts with one that's about
+# to run out
+DEFAULT_TOKEN_REFRESH_MARGIN = timedelta(minutes=5)
+TOKEN_REFRESH_TIMEOUT = (3.05, 15)  # (connect, read) seconds for the call to Spotify's token endpoint
+# How long a process may hold a profile's refresh lock (where the database has no row locks). Comfortably longer than
+# the refresh call, so a waiter never gives up on a holder that's still refreshing
+TOKEN_LOCK_TIMEOUT = 60
+
+_tokens: dict[int, tuple[str, object]] = {}  # Profile pk -> (access token, expiry) of the newest token we've seen
+_profile_locks: dict[int, threading.Lock] = {}
+_profile_locks_lock = threading.Lock()
+
+
+def get_access_token(spotify_profile, force: bool = False) -> str | None:
+    """Return a valid access token for <spotify_profile>, refreshing it first if it's about to expire.
+
+    Returns None if the token couldn't be refreshed (i.e. the user must re-authorize with Spotify). Valid tokens are
+    cached in-process, so the hot path reads neither Spotify nor the profile row, and concurrent refreshes of the same
+    profile, across threads and processes, are coalesced into a single call to Spotify. <spotify_profile> is updated
+    with the token it returns.
+
+    With <force>, the token is refreshed even if it hasn't expired (e.g. to find out whether the user revoked access),
+    unless another call has refreshed it since <spotify_profile> was loaded.
+    """
+    seen_token = spotify_profile.access_token
+
+    if not force:
+        if _is_fresh(spotify_profile.access_token_expiry):
+            return spotify_profile.access_token
+
+        # e.g. refreshed by another request in this process since <spotify_profile> was loaded
+        if _use_cached_token(spotify_profile):
+            return spotify_profile.access_token
+
+    with _get_profile_lock(spotify_profile.pk):
+        # Another thread may have refreshed it while we waited
+        if _use_cached_token(spotify_profile, replacing=seen_token if force else None):
+            return spotify_profile.access_token
+
+        with _locked_profile(spotify_profile) as (current_profile, locked):
+            # ... or another process
+            needs_refresh = (not _is_fresh(current_profile.access_token_expiry)
+                             or (force and current_profile.access_token == seen_token))
+
+            # If the lock couldn't be taken, another process is still refreshing (or died doing so); refreshing too
+            # would race it, and whichever saved last would overwrite the other's tokens
+            if needs_refresh and (not locked or not refresh_curr_tokens(current_profile)):
+                return None
+
+        spotify_profile.access_token = current_profile.access_token
+        spotify_profile.refresh_token = current_profile.refresh_token
+        spotify_profile.access_token_expiry = current_profile.access_token_expiry
+        _tokens[spotify_profile.pk] = (current_profile.access_token, current_profile.access_token_expiry)
+
+        return spotify_profile.access_token
+
+
+def refresh_curr_tokens(spotify_profile) -> bool:
+    """Refresh and save user spotify tokens. Return whether tokens were succesfully saved.
+
+    Always calls Spotify; use <get_access_token> unless a refresh is needed regardless of the token's expiry.
+    """
+    refresh_url = "https://accounts.spotify.com/api/token"
+    refresh_token = spotify_profile.refresh_token
+
+    headers = {
+        'Content-Type': 'application/x-www-form-urlencoded'
+    }
+
+    client_id = os.environ.get("SPOTIFY_CLIENT_ID", None)
+
+    if client_id is None:
+        return False
+
+    body = urlencode({
+        "grant_type": "refresh_token",
+        "refresh_token": refresh_token,
+        "client_id": client_id
+    })
+
+    response = limited_request("POST", url=refresh_url, data=body, headers=headers, timeout=TOKEN_REFRESH_TIMEOUT)
+
+    # i.e. Refresh token has expired; return None upstream until the View recieves it, then return an HTTP-Response
+    # that the frontend recieves --> this triggers redirect to OAuth.
+    if response.status_code == 401:
+        return False
+
+    try:
+        data = response.json()
+
+        access_token = data["access_token"]
+        access_token_expiry = now() + timedelta(seconds=data["expires_in"])
+
+        # Per Spotify API, refresh token may be replaced or maintained after new access token is issued
+        refresh_token = data.get("refresh_token", refresh_token)
+
+        spotify_profile.access_token = access_token
+        spotify_profile.refresh_token = refresh_token
+        spotify_profile.access_token_expiry = access_token_expiry
+
+        # Only the token fields, so the rest of a profile loaded earlier can't overwrite newer values
+        spotify_profile.save(update_fields=["access_token", "refresh_token", "access_token_expiry"])
+        _tokens[spotify_profile.pk] = (access_token, access_token_expiry)
+
+        return True
+    except KeyError as e:
+        print(e)
+        return False
+
+
+def _is_fresh(access_token_expiry) -> bool:
+    margin = getattr(settings, "SPOTIFY_TOKEN_REFRESH_MARGIN", DEFAULT_TOKEN_REFRESH_MARGIN)
+
+    return access_token_expiry is not None and now() < access_token_expiry - margin
+
+
+def _use_cached_token(spotify_profile, replacing: str | None = None) -> bool:
+    """Use the newest token seen in this process for <spotify_profile>, unless it's about to expire or is <replacing>"""
+    cached = _tokens.get(spotify_profile.pk)
+
+    if cached is None or not _is_fresh(cached[1]) or cached[0] == replacing:
+        return False
+
+    spotify_profile.access_token, spotify_profile.access_token_expiry = cached
+    return True
+
+
+def _get_profile_lock(pk: int) -> threading.Lock:
+    with _profile_locks_lock:
+        if pk not in _profile_locks:
+            _profile_locks[pk] = threading.Lock()
+
+        return _profile_locks[pk]
+
+
+@contextmanager
+def _locked_profile(spotify_profile):
+    """Yield (a fresh copy of <spotify_profile>, whether it's locked).
+
+    While it's locked, no other process can refresh it until the block exits. It's only left unlocked if another
+    process held the lock for longer than TOKEN_LOCK_TIMEOUT; the copy is then read after waiting for it.
+    """
+    if connection.features.has_select_for_update:
+        with transaction.atomic():
+            yield UserSpotifyProfile.objects.select_for_update().get(pk=spotify_profile.pk), True
+    else:
+        # e.g. SQLite, which has no row locks
+        with CacheLock(f"spotify-token:{spotify_profile.pk}:lock", timeout=TOKEN_LOCK_TIMEOUT) as lock:
+            yield UserSpotifyProfile.objects.get(pk=spotify_profile.pk), lock.acquired